@@ -1,10 +1,22 @@
 import os
+import sys
 import json
+import atexit
+import signal
+import hashlib
+import heapq
+import random
 import uuid
 import asyncio
+import gzip
+import sqlite3
+import tempfile
 import threading
 import time
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from datetime import datetime, timedelta
 import os
 os.environ['TZ'] = 'Africa/Cairo'
 try:
@@ -12,24 +24,45 @@ try:
     _time.tzset()
 except:
     pass
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
 import firebase_admin
 from firebase_admin import credentials, messaging
+from firebase_admin import exceptions as firebase_exceptions
 import aiohttp
-from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, unquote
+
+# Faster JSON decoding when orjson is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Brotli responses for /scope when the module is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Google Drive
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-import io
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, MediaIoBaseUpload, build_http
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: a single worker process is assumed
+    fcntl = None
 
 # ==========================================
 # 1. Config
 # ==========================================
-FIREBASE_DB_URL = "https://libirary-b2424-default-rtdb.firebaseio.com"
+FIREBASE_DB_URL = os.environ.get("FIREBASE_DB_URL", "https://libirary-b2424-default-rtdb.firebaseio.com")
 DEFAULT_SCOPE_KEY = "ميكانيكا__second__term2"
 DRIVE_FOLDER_ID = "1T0MwUb-dc3UN3hMjrio1GVT6lm1mQl4Q"
 
@@ -40,44 +73,131 @@ REFRESH_TOKEN = '1//03q20b0Cf_68JCgYIARAAGAMSNwF-L9IraDttb8qA8N_0sVb8HIdO90fMQYF
 
 RAILWAY_URL = "https://web-production-ae004.up.railway.app"
 
+# Google endpoints; overridden by the offline benchmark (bench/fake_drive.py)
+DRIVE_API_ENDPOINT = os.environ.get("DRIVE_API_ENDPOINT")
+GOOGLE_API_ROOT  = (DRIVE_API_ENDPOINT or "https://www.googleapis.com").rstrip('/') + '/'
+GOOGLE_TOKEN_URI = os.environ.get("GOOGLE_TOKEN_URI", "https://oauth2.googleapis.com/token")
+
+# "stream" listens to RTDB server-sent events and only polls while the
+# stream is down; "poll" always sweeps every scope on a timer.
+WATCHER_MODE = os.environ.get("WATCHER_MODE", "stream")
+
+# "auto": every worker process competes for WATCHER_LOCK_PATH and only the
+# holder runs the watchers; "never": this process only serves HTTP.
+RUN_WATCHERS = os.environ.get("RUN_WATCHERS", "auto")
+WATCHER_LOCK_PATH = os.environ.get("WATCHER_LOCK_PATH", os.path.join(tempfile.gettempdir(), "unibot-watchers.lock"))
+
 # ==========================================
 # 2. Firebase init
 # ==========================================
-try:
-    sa_json = os.environ.get("SERVICE_ACCOUNT_JSON")
-    if sa_json:
-        sa_dict = json.loads(sa_json)
-        cred = credentials.Certificate(sa_dict)
-    else:
-        cred = credentials.Certificate("service-account.json")
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(cred)
-    print("✅ Firebase initialized")
-except Exception as e:
-    print(f"❌ Firebase Init Error: {e}")
+# Initialised on the first FCM call rather than at import, so a worker
+# can serve requests before the service account is read.
+firebase_state = {'app': None}
+firebase_lock = threading.Lock()
+
+def firebase_app():
+    with firebase_lock:
+        if firebase_state['app'] is None:
+            try:
+                sa_json = os.environ.get("SERVICE_ACCOUNT_JSON")
+                if sa_json:
+                    sa_dict = json.loads(sa_json)
+                    cred = credentials.Certificate(sa_dict)
+                else:
+                    cred = credentials.Certificate("service-account.json")
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app(cred)
+                firebase_state['app'] = firebase_admin.get_app()
+                print("✅ Firebase initialized")
+            except Exception as e:
+                print(f"❌ Firebase Init Error: {e}")
+        return firebase_state['app']
 
 # ==========================================
 # 3. Google Drive init
 # ==========================================
 SCOPES = ['https://www.googleapis.com/auth/drive']
-drive_credentials = Credentials(
-    token=None,
-    refresh_token=REFRESH_TOKEN,
-    token_uri="https://oauth2.googleapis.com/token",
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    scopes=SCOPES
-)
+DRIVE_BATCH_SIZE = 100  # Drive batch requests hold at most 100 calls
+drive_token_lock = threading.Lock()
+drive_local = threading.local()
+
+class SharedRefreshCredentials(Credentials):
+    """OAuth credentials shared by every thread's Drive client.
+
+    The access token is refreshed under a lock and only if no other thread
+    has already replaced it, instead of once per client instance. A token
+    that is still locally valid is refreshed too: that is the retry after
+    Google answered 401.
+    """
+
+    def refresh(self, request):
+        failed_token = self.token  # the token this caller saw expire or fail
+        with drive_token_lock:
+            if self.token != failed_token and self.valid:
+                return  # another thread refreshed it while this one waited
+            super().refresh(request)
+
+drive_state = {'credentials': None}
+
+def drive_credentials():
+    """The process-wide Drive credentials, built on first use"""
+    with drive_token_lock:
+        if drive_state['credentials'] is None:
+            drive_state['credentials'] = SharedRefreshCredentials(
+                token=None,
+                refresh_token=REFRESH_TOKEN,
+                token_uri=GOOGLE_TOKEN_URI,
+                client_id=CLIENT_ID,
+                client_secret=CLIENT_SECRET,
+                scopes=SCOPES
+            )
+        return drive_state['credentials']
 
 def get_drive_service():
-    try:
-        import httplib2
-        from google_auth_httplib2 import AuthorizedHttp
-        http = httplib2.Http()
-        authorized_http = AuthorizedHttp(drive_credentials, http=http)
-        return build('drive', 'v3', http=authorized_http)
-    except ImportError:
-        return build('drive', 'v3', credentials=drive_credentials)
+    """Drive client for the calling thread, built once from the bundled
+    discovery document (httplib2.Http objects are not thread-safe)."""
+    service = getattr(drive_local, 'service', None)
+    if service is None:
+        options = {'client_options': {'api_endpoint': GOOGLE_API_ROOT + 'drive/v3/'}} if DRIVE_API_ENDPOINT else {}
+        try:
+            from google_auth_httplib2 import AuthorizedHttp
+            # build_http() stops httplib2 from following the 308s of resumable uploads
+            http = build_http()
+            authorized_http = AuthorizedHttp(drive_credentials(), http=http)
+            service = build('drive', 'v3', http=authorized_http, static_discovery=True, cache_discovery=False, **options)
+        except ImportError:
+            service = build('drive', 'v3', credentials=drive_credentials(), static_discovery=True, cache_discovery=False, **options)
+        drive_local.service = service
+    return service
+
+def execute_drive_batch(service, requests_by_id):
+    """Run {request_id: HttpRequest} through BatchHttpRequest (100 per batch).
+
+    Returns {request_id: (response, exception)}. Media uploads cannot be
+    batched; metadata calls such as permissions().create and folder
+    files().create can.
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    items = list(requests_by_id.items())
+    for i in range(0, len(items), DRIVE_BATCH_SIZE):
+        # The batch URI comes from the discovery document, not api_endpoint
+        batch = BatchHttpRequest(callback=callback, batch_uri=GOOGLE_API_ROOT + 'batch/drive/v3')
+        for request_id, http_request in items[i:i + DRIVE_BATCH_SIZE]:
+            batch.add(http_request, request_id=request_id)
+        drive_execute(batch, 'batch', retries=0)
+    return results
+
+def make_files_public(service, file_ids):
+    """Grant anyone-with-link read access to several files in batched calls"""
+    results = execute_drive_batch(service, {
+        file_id: service.permissions().create(fileId=file_id, body={'type': 'anyone', 'role': 'reader'})
+        for file_id in file_ids
+    })
+    return {file_id: exc for file_id, (_, exc) in results.items() if exc}
 
 # ==========================================
 # 4. Flask App
@@ -85,14 +205,640 @@ def get_drive_service():
 app_flask = Flask(__name__)
 CORS(app_flask, origins=["https://peacemaker3050-ux.github.io"])
 
+# --- Cross-process helpers ---
+# gunicorn runs several worker processes; state that any of them may read
+# lives in small JSON files guarded by flock.
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by every process (and thread) on this machine"""
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def read_json_file(path, default=None):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        print(f"JSON read error [{path}]: {e}")
+        return default
+
+def write_json_file(path, value, private=False):
+    # Atomic replace; the temp name is per process so writers never collide.
+    # private=True creates the file owner-only (it holds FCM tokens)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    mode = 0o600 if private else 0o666
+    with open(tmp_path, 'w', encoding='utf-8', opener=lambda p, flags: os.open(p, flags, mode)) as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# --- Metrics ---
+# Minimal Prometheus-style counters and histograms, rendered by /metrics
+# in the text exposition format. Values are per process: watcher, sweep
+# and outbox series only move in the leader (see unibot_process_info).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metrics_registry = []
+
+def metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(l, '')) for l in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{metric_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(l, '')) for l in self.labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{metric_labels(self.labels, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{metric_labels(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{metric_labels(self.labels, key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{metric_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+class GaugeCollector:
+    """Gauge whose samples come from `collect()` -> {label values tuple: value}
+
+    kind='counter' exposes running totals kept elsewhere (name them *_total).
+    """
+    def __init__(self, name, help_text, labels, collect, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.kind = kind
+        metrics_registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            print(f"Metrics collect error [{self.name}]: {e}")
+            samples = {}
+        for key, value in sorted(samples.items()):
+            lines.append(f"{self.name}{metric_labels(self.labels, key)} {value}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+rtdb_request_seconds = Histogram('unibot_rtdb_request_seconds', 'Firebase RTDB REST call latency', ('op', 'scope'))
+rtdb_requests_total = Counter('unibot_rtdb_requests_total', 'Firebase RTDB REST calls by outcome', ('op', 'scope', 'status'))
+scope_cache_age_seconds = Histogram('unibot_scope_cache_age_seconds', 'Age of scope cache values when served',
+                                    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+fcm_send_each_seconds = Histogram('unibot_fcm_send_each_seconds', 'messaging.send_each batch latency')
+fcm_batch_size = Histogram('unibot_fcm_batch_size', 'Messages per send_each batch',
+                           buckets=(1, 10, 50, 100, 250, 500))
+fcm_messages_total = Counter('unibot_fcm_messages_total', 'FCM messages by outcome', ('outcome',))
+fcm_token_failures_total = Counter('unibot_fcm_token_failures_total', 'Failed FCM tokens by error', ('reason',))
+drive_call_seconds = Histogram('unibot_drive_call_seconds', 'Google Drive API call latency', ('op',))
+drive_calls_total = Counter('unibot_drive_calls_total', 'Google Drive API calls by outcome', ('op', 'outcome'))
+watcher_handler_seconds = Histogram('unibot_watcher_handler_seconds', 'Watcher handler run time per scope', ('handler',))
+watcher_handler_errors_total = Counter('unibot_watcher_handler_errors_total', 'Watcher handler exceptions', ('handler',))
+sweep_seconds = Histogram('unibot_sweep_seconds', 'Duration of one sweep tick', ('mode',))
+watcher_lag_seconds = Histogram('unibot_watcher_lag_seconds', 'How late a scope poll or handler ran behind schedule',
+                                ('mode',), buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300))
+schedule_fire_lag_seconds = Histogram('unibot_schedule_fire_lag_seconds', 'Schedule fire time minus due time',
+                                      buckets=(0.05, 0.1, 0.5, 1, 5, 30, 60, 300))
+outbox_delivery_seconds = Histogram('unibot_outbox_delivery_seconds', 'Outbox message delivery time', ('kind',))
+outbox_queue_seconds = Histogram('unibot_outbox_queue_seconds', 'Outbox message enqueue-to-sent time', ('kind',),
+                                 buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900))
+
 # ==========================================
 # 5. Helper: get database
 # ==========================================
-db_cache = None
-last_cache_time = 0
-CACHE_DURATION = 60
-db_cache_by_scope = {}
-last_cache_time_by_scope = {}
+CACHE_DURATION = 60           # fresh for this long
+CACHE_STALE_DURATION = 300    # then served stale while a refresh runs
+CACHE_MAX_SCOPES = 256
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Egress counters: bytes downloaded vs bytes avoided by 304/shallow reads
+fetch_stats = {
+    'requests': 0,
+    'not_modified': 0,
+    'parse_skipped': 0,
+    'bytes_fetched': 0,
+    'bytes_saved': 0,
+}
+fetch_stats_lock = threading.Lock()
+
+def count_fetch(**deltas):
+    with fetch_stats_lock:
+        for k, v in deltas.items():
+            fetch_stats[k] += v
+
+class ScopeCache:
+    """Thread-safe TTL/LRU cache of parsed scope snapshots.
+
+    Entries are fresh for `ttl` seconds, then served for another
+    `stale_ttl` seconds while one background refresh runs. Concurrent
+    misses for the same scope share a single `loader(key, prev_entry)`
+    call. Least recently used entries are evicted past `max_entries` or
+    `max_bytes` (estimated from the downloaded body size). A failed load
+    keeps the old value but records the error, so meta() can tell callers
+    how stale it is. A loader raises KeyError when the node does not exist:
+    nothing is cached for it and get() re-raises.
+    """
+
+    def __init__(self, loader, ttl, stale_ttl, max_entries, max_bytes):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0,
+            'coalesced': 0, 'load_errors': 0, 'evictions': 0,
+        }
+
+    def get(self, key, force_refresh=False):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not force_refresh:
+                age = time.time() - entry['fetched_at']
+                scope_cache_age_seconds.observe(age)
+                if age < self.ttl:
+                    self.counters['hits'] += 1
+                    self.entries.move_to_end(key)
+                    return entry['value']
+                if age < self.ttl + self.stale_ttl:
+                    self.counters['stale_hits'] += 1
+                    self.entries.move_to_end(key)
+                    if key not in self.inflight:
+                        threading.Thread(target=self.refresh, args=(key,), daemon=True).start()
+                    return entry['value']
+            self.counters['refreshes' if force_refresh else 'misses'] += 1
+        return self.load(key)
+
+    def load(self, key):
+        """Fetch `key` once no matter how many threads ask concurrently"""
+        with self.lock:
+            event = self.inflight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.inflight[key] = event
+            else:
+                self.counters['coalesced'] += 1
+        missing = None
+        if leader:
+            try:
+                entry = self.loader(key, self.peek_entry(key))
+                if entry:
+                    self.put(key, entry)
+                else:
+                    self.record_error(key, "load failed")
+            except KeyError as e:
+                self.discard(key)
+                missing = e
+            except Exception as e:
+                self.record_error(key, e)
+                print(f"Cache load error [{key}]: {e!r}")
+            finally:
+                with self.lock:
+                    self.inflight.pop(key, None)
+                event.set()
+        else:
+            event.wait()
+        if missing:
+            raise missing
+        entry = self.peek_entry(key)
+        return entry['value'] if entry else None
+
+    def refresh(self, key):
+        try:
+            self.load(key)
+        except KeyError:
+            pass
+
+    def peek_entry(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, entry):
+        entry = dict(entry)
+        entry.setdefault('fetched_at', time.time())
+        entry.setdefault('size', 0)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= old['size']
+            self.entries[key] = entry
+            self.total_bytes += entry['size']
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted['size']
+                self.counters['evictions'] += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= old['size']
+
+    def record_error(self, key, error):
+        with self.lock:
+            self.counters['load_errors'] += 1
+            entry = self.entries.get(key)
+            if entry:
+                entry['last_error'] = str(error) or type(error).__name__
+                entry['error_at'] = time.time()
+
+    def meta(self, key):
+        """Staleness of a cached value: age, whether it is past `ttl`, and
+        the last refresh error if the newest load failed"""
+        entry = self.peek_entry(key)
+        if not entry:
+            return {'cached': False}
+        age = time.time() - entry['fetched_at']
+        failing = entry.get('error_at', 0) > entry['fetched_at']
+        return {
+            'cached': True,
+            'fetchedAt': int(entry['fetched_at'] * 1000),
+            'ageSeconds': round(age, 1),
+            'stale': age >= self.ttl,
+            'lastError': entry.get('last_error') if failing else None,
+        }
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.total_bytes)
+
+# --- Resilience: circuit breakers, retry budget, hedged reads ---
+# Every outbound call goes through call_with_resilience(endpoint, fn):
+# - one CircuitBreaker per endpoint ('rtdb', 'fcm', 'drive') opens after
+#   BREAKER_THRESHOLD consecutive failures and rejects calls for
+#   BREAKER_COOLDOWN seconds, then lets a single probe through;
+# - transient failures are retried with jittered exponential backoff, but
+#   each retry spends a token from a shared budget that only refills by
+#   RETRY_BUDGET_RATIO per call, so retries never multiply load in an
+#   outage;
+# - small reads can be hedged: a second identical request is sent if the
+#   first has not answered within HEDGE_AFTER seconds, the first answer
+#   wins and the other is cancelled or closed. Only the shallow scope list
+#   and scope paths whose last body was at most HEDGE_MAX_BYTES qualify;
+#   hedging a multi-MB document would just download it twice.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MAX = 20
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 2
+HEDGE_AFTER = 1.0
+HEDGE_MAX_BYTES = 64 * 1024
+RTDB_TIMEOUT = (3, 10)  # connect, read
+
+class CircuitOpenError(Exception):
+    pass
+
+class TransientError(Exception):
+    """A response worth retrying (5xx / 429)"""
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+        self.counters = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                self.counters['calls'] += 1
+                return True
+            if not self.probing and time.time() - self.opened_at >= self.cooldown:
+                self.probing = True  # half-open: one trial call
+                self.counters['calls'] += 1
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                if self.opened_at is not None:
+                    print(f"🔌 Circuit closed: {self.name}")
+                self.failures = 0
+                self.opened_at = None
+                self.probing = False
+                return
+            self.counters['failures'] += 1
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    self.counters['opened'] += 1
+                    print(f"🔌 Circuit open: {self.name} ({self.failures} failures)")
+                self.opened_at = time.time()
+                self.probing = False
+
+    def stats(self):
+        with self.lock:
+            state = 'closed' if self.opened_at is None else ('half-open' if self.probing else 'open')
+            return dict(self.counters, state=state)
+
+class RetryBudget:
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, max_tokens=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+        self.counters = {'retries': 0, 'denied': 0}
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.counters['retries'] += 1
+                return True
+            self.counters['denied'] += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, tokens=round(self.tokens, 1))
+
+breakers = {name: CircuitBreaker(name) for name in ('rtdb', 'fcm', 'drive')}
+retry_budget = RetryBudget()
+hedge_stats = {'hedged': 0, 'hedge_won': 0}
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def is_transient(e):
+    if isinstance(e, (TransientError, requests.ConnectionError, requests.Timeout,
+                      aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, HttpError):
+        return e.resp.status in (429, 500, 502, 503, 504)
+    return isinstance(e, (firebase_exceptions.UnavailableError, firebase_exceptions.InternalError,
+                          firebase_exceptions.DeadlineExceededError))
+
+def hedged(fn, after=HEDGE_AFTER):
+    """Run fn(); if it is still pending after `after` seconds, race a second call"""
+    first = hedge_executor.submit(fn)
+    done, _ = wait_futures([first], timeout=after)
+    if done:
+        return first.result()
+    hedge_stats['hedged'] += 1
+    second = hedge_executor.submit(fn)
+    done, _ = wait_futures([first, second], return_when=FIRST_COMPLETED)
+    winner = next(iter(done))
+    if winner.exception() is not None:
+        winner = second if winner is first else first
+    if winner is second:
+        hedge_stats['hedge_won'] += 1
+    loser = first if winner is second else second
+    if not loser.cancel():
+        loser.add_done_callback(discard_result)
+    return winner.result()
+
+def discard_result(future):
+    """Release the connection held by a hedge loser's response"""
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), 'close', None)
+        if close:
+            close()
+
+def hedge_worthy(prev):
+    """Hedge a scope read only if its last body was known to be small"""
+    return bool(prev) and prev.get('size', HEDGE_MAX_BYTES + 1) <= HEDGE_MAX_BYTES
+
+async def hedged_async(make_coro, after=HEDGE_AFTER):
+    first = asyncio.ensure_future(make_coro())
+    done, _ = await asyncio.wait({first}, timeout=after)
+    if done:
+        return first.result()
+    hedge_stats['hedged'] += 1
+    second = asyncio.ensure_future(make_coro())
+    done, pending = await asyncio.wait({first, second}, return_when=asyncio.FIRST_COMPLETED)
+    winner = next(iter(done))
+    if winner.exception() is not None and pending:
+        winner = pending.pop()
+        await asyncio.wait({winner})
+    for task in pending:
+        task.cancel()
+    if winner is second:
+        hedge_stats['hedge_won'] += 1
+    return winner.result()
+
+def call_with_resilience(endpoint, fn, retries=2, hedge=False):
+    breaker = breakers[endpoint]
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f"{endpoint} circuit open")
+        try:
+            result = hedged(fn) if hedge else fn()
+        except Exception as e:
+            transient = is_transient(e)
+            breaker.record(not transient)  # a 4xx says nothing about health
+            if not transient or attempt >= retries or not retry_budget.withdraw():
+                raise
+            attempt += 1
+            time.sleep(backoff_delay(attempt))
+            continue
+        breaker.record(True)
+        return result
+
+async def call_with_resilience_async(endpoint, make_coro, retries=2, hedge=False):
+    breaker = breakers[endpoint]
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f"{endpoint} circuit open")
+        try:
+            result = await (hedged_async(make_coro) if hedge else make_coro())
+        except Exception as e:
+            transient = is_transient(e)
+            breaker.record(not transient)
+            if not transient or attempt >= retries or not retry_budget.withdraw():
+                raise
+            attempt += 1
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        breaker.record(True)
+        return result
+
+def scope_label(scope):
+    """Metric label for a scope. Any client can name a scope in a URL, so
+    only scopes known to exist (data seen, or in the shallow scope list)
+    get their own series; the rest share 'other'."""
+    if not scope or scope in scope_shapes or scope in scope_list['keys']:
+        return scope
+    return 'other'
+
+def observe_rtdb(op, scope, started, status):
+    scope = scope_label(scope)
+    rtdb_request_seconds.observe(time.perf_counter() - started, op=op, scope=scope)
+    rtdb_requests_total.inc(op=op, scope=scope, status=status)
+
+def rtdb_request(method, url, hedge=False, retries=2, op=None, scope='', **kwargs):
+    """RTDB REST call through the 'rtdb' breaker; pass hedge=True only for
+    small reads. `op`/`scope` label the latency metrics."""
+    kwargs.setdefault('timeout', RTDB_TIMEOUT)
+    op = op or method.lower()
+
+    def attempt():
+        started = time.perf_counter()
+        try:
+            resp = http_session().request(method, url, **kwargs)
+        except Exception as e:
+            observe_rtdb(op, scope, started, type(e).__name__)
+            raise
+        observe_rtdb(op, scope, started, resp.status_code)
+        if resp.status_code >= 500 or resp.status_code == 429:
+            raise TransientError(f"HTTP {resp.status_code}")
+        return resp
+
+    return call_with_resilience('rtdb', attempt, retries=retries, hedge=hedge)
+
+def drive_call(op, fn, retries=2):
+    """Drive API call through the 'drive' breaker, timed under `op`"""
+    def attempt():
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            drive_calls_total.inc(op=op, outcome=type(e).__name__)
+            raise
+        finally:
+            drive_call_seconds.observe(time.perf_counter() - started, op=op)
+        drive_calls_total.inc(op=op, outcome='ok')
+        return result
+
+    return call_with_resilience('drive', attempt, retries=retries)
+
+def drive_execute(http_request, op, retries=2):
+    """HttpRequest.execute() through drive_call()"""
+    return drive_call(op, http_request.execute, retries=retries)
+
+def resilience_stats():
+    return {
+        'breakers': {name: b.stats() for name, b in breakers.items()},
+        'retry_budget': retry_budget.stats(),
+        'hedges': dict(hedge_stats),
+    }
+
+# --- Pooled HTTP clients ---
+# One keep-alive requests.Session for blocking calls, and one aiohttp
+# session living on a background event loop for concurrent scope fetches.
+HTTP_POOL_SIZE = 32
+SCOPE_FETCH_CONCURRENCY = 16
+SCOPE_FETCH_TIMEOUT = 10
+SWEEP_DEADLINE = 15  # upper bound on one sweep's fetch phase
+http_clients = {'session': None, 'loop': None, 'aiohttp': None}
+http_clients_lock = threading.Lock()
+
+def http_session():
+    with http_clients_lock:
+        if http_clients['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            http_clients['session'] = session
+        return http_clients['session']
+
+def async_loop():
+    with http_clients_lock:
+        if http_clients['loop'] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            http_clients['loop'] = loop
+        return http_clients['loop']
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared event loop from any thread"""
+    return asyncio.run_coroutine_threadsafe(coro, async_loop()).result(timeout)
+
+async def aiohttp_session():
+    # Only touched from the event loop thread
+    session = http_clients['aiohttp']
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SCOPE_FETCH_CONCURRENCY, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=SCOPE_FETCH_TIMEOUT),
+        )
+        http_clients['aiohttp'] = session
+    return session
 
 def normalize_scope_key(scope_key):
     s = (scope_key or DEFAULT_SCOPE_KEY).strip()
@@ -102,40 +848,238 @@ def scoped_db_base(scope_key=None):
     safe_scope = quote(normalize_scope_key(scope_key), safe='')
     return f"{FIREBASE_DB_URL}/scopes/{safe_scope}"
 
+# --- Decoding ---
+# The `data` node is usually a JSON string. Decoded documents are kept by
+# content hash, so an unchanged string (a 200 without ETag support, or a
+# stream event that only touched userTokens) is never parsed twice.
+# Documents handed out from here are shared: treat them as read-only.
+PARSE_CACHE_SIZE = CACHE_MAX_SCOPES
+parse_cache = OrderedDict()
+parse_cache_lock = threading.Lock()
+
+def decode_data_string(text):
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    with parse_cache_lock:
+        parsed = parse_cache.get(digest)
+        if parsed is not None:
+            parse_cache.move_to_end(digest)
+    if parsed is not None:
+        count_fetch(parse_skipped=1)
+        return parsed
+    parsed = json_loads(text)
+    with parse_cache_lock:
+        parse_cache[digest] = parsed
+        while len(parse_cache) > PARSE_CACHE_SIZE:
+            parse_cache.popitem(last=False)
+    return parsed
+
+def parse_scope_doc(raw):
+    """Unwrap the (possibly double-encoded) `data` field of a scope document"""
+    parsed = raw
+    while isinstance(parsed, dict) and isinstance(parsed.get('data'), str):
+        try:
+            parsed = decode_data_string(parsed['data'])
+        except:
+            break
+    if isinstance(parsed, dict) and isinstance(parsed.get('data'), dict):
+        parsed = parsed['data']
+    return parsed if isinstance(parsed, dict) and parsed else {"database": {}}
+
+# --- Path cache ---
+# Entries are keyed by (scope, path) and hold one node of the scope, so a
+# consumer only downloads what it reads:
+#   'data'             -> the decoded document
+#   'data/<key>'       -> one top-level subtree (tree-shaped scopes only)
+#   'userTokens', 'scheduleTriggers'
+# A scope is 'tree'-shaped when its `data` node is stored as JSON; when it
+# is a JSON string it can only be fetched whole.
+scope_shapes = {}
+
+def scope_fetch_headers(prev):
+    headers = {'X-Firebase-ETag': 'true'}
+    if prev and prev.get('etag'):
+        headers['If-None-Match'] = prev['etag']
+    return headers
+
+def scope_path_url(key):
+    scope, path = key
+    return f"{scoped_db_base(scope)}/{path}.json"
+
+def scope_entry_from_response(key, prev, status, body, etag):
+    """Turn a (possibly conditional) scope GET into a ScopeCache entry"""
+    scope, path = key
+    cached_etag = prev.get('etag') if prev else None
+    if status == 304 or (status == 200 and etag and etag == cached_etag):
+        # Unchanged since the last fetch: keep the parsed value
+        if status == 304:
+            count_fetch(requests=1, not_modified=1, bytes_saved=prev['size'])
+        else:
+            count_fetch(requests=1, parse_skipped=1, bytes_fetched=len(body))
+        return dict(prev, fetched_at=time.time())
+    if status != 200:
+        print(f"DB Fetch Error [{scope}/{path}]: HTTP {status}")
+        return None
+    count_fetch(requests=1, bytes_fetched=len(body))
+    node = json_loads(body)
+    if path == 'data' and node is None:
+        raise KeyError(scope)  # no such scope: not cached
+    if path == 'data':
+        scope_shapes[scope] = 'tree' if isinstance(node, dict) and 'data' not in node else 'string'
+        value = parse_scope_doc({'data': node})
+    elif path == 'userTokens':
+        value = node or {}
+        update_token_registry(scope, value)
+    else:
+        value = node
+    return {'value': value, 'etag': etag, 'size': len(body)}
+
+def rtdb_op(path):
+    return 'get_subtree' if path.startswith('data/') else f"get_{path}"
+
+def fetch_scope_path(key, prev):
+    """ScopeCache loader: conditional GET of one (scope, path) node"""
+    resp = rtdb_request('GET', scope_path_url(key), hedge=hedge_worthy(prev), op=rtdb_op(key[1]), scope=key[0],
+                        headers=scope_fetch_headers(prev))
+    return scope_entry_from_response(key, prev, resp.status_code, resp.content, resp.headers.get('ETag'))
+
+async def fetch_scope_paths_async(keys, deadline):
+    session = await aiohttp_session()
+    sem = asyncio.Semaphore(SCOPE_FETCH_CONCURRENCY)
+
+    async def fetch_one(key):
+        prev = scope_cache.peek_entry(key)
+
+        async def get_once():
+            started = time.perf_counter()
+            try:
+                async with session.get(scope_path_url(key), headers=scope_fetch_headers(prev)) as resp:
+                    body = await resp.read()
+            except Exception as e:
+                observe_rtdb(rtdb_op(key[1]), key[0], started, type(e).__name__)
+                raise
+            observe_rtdb(rtdb_op(key[1]), key[0], started, resp.status)
+            if resp.status >= 500 or resp.status == 429:
+                raise TransientError(f"HTTP {resp.status}")
+            return resp.status, body, resp.headers.get('ETag')
+
+        async with sem:
+            status, body, etag = await call_with_resilience_async('rtdb', get_once, hedge=hedge_worthy(prev))
+        return scope_entry_from_response(key, prev, status, body, etag)
+
+    # Whatever has not answered by the deadline is abandoned for this
+    # sweep; those scopes keep their cached (and flagged stale) snapshot
+    tasks = {asyncio.ensure_future(fetch_one(k)): k for k in keys}
+    done, pending = await asyncio.wait(tasks, timeout=deadline) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+    results = {}
+    for task, key in tasks.items():
+        if task in pending:
+            results[key] = TimeoutError("sweep deadline")
+        else:
+            results[key] = task.exception() or task.result()
+    return results
+
+def refresh_scope_paths(keys, deadline=SWEEP_DEADLINE):
+    """Fetch many (scope, path) nodes concurrently (bounded) into the cache,
+    giving up on the stragglers after `deadline` seconds"""
+    try:
+        results = run_async(fetch_scope_paths_async(keys, deadline), timeout=deadline + 5)
+    except Exception as e:
+        print(f"Scopes refresh error: {e}")
+        return
+    for key, entry in results.items():
+        if isinstance(entry, KeyError):
+            scope_cache.discard(key)
+        elif isinstance(entry, Exception):
+            scope_cache.record_error(key, entry)
+            print(f"DB Fetch Error [{key[0]}/{key[1]}]: {entry!r}")
+        elif entry:
+            scope_cache.put(key, entry)
+
+scope_cache = ScopeCache(
+    fetch_scope_path,
+    ttl=CACHE_DURATION,
+    stale_ttl=CACHE_STALE_DURATION,
+    max_entries=CACHE_MAX_SCOPES * 8,
+    max_bytes=CACHE_MAX_BYTES,
+)
+
 def get_database_sync(force_refresh=False, scope_key=None):
-    global db_cache, last_cache_time, db_cache_by_scope, last_cache_time_by_scope
     scope = normalize_scope_key(scope_key)
-    now = time.time()
-    if not force_refresh and db_cache_by_scope.get(scope) and (now - last_cache_time_by_scope.get(scope, 0) < CACHE_DURATION):
-        return db_cache_by_scope[scope]
     try:
-        import requests
-        resp = requests.get(f"{scoped_db_base(scope)}/.json", timeout=10)
-        if resp.status_code == 200:
-            raw = resp.json()
-            parsed = raw
-            while parsed and isinstance(parsed.get('data'), str):
-                try:
-                    parsed = json.loads(parsed['data'])
-                except:
-                    break
-            if parsed and isinstance(parsed.get('data'), dict):
-                parsed = parsed['data']
-            db_cache = parsed if parsed else {"database": {}}
-            db_cache_by_scope[scope] = db_cache
-            last_cache_time_by_scope[scope] = now
-            last_cache_time = now
-            return db_cache_by_scope[scope]
-    except Exception as e:
-        print(f"DB Fetch Error: {e}")
-    return db_cache_by_scope.get(scope) if db_cache_by_scope.get(scope) else {"database": {}}
+        db = scope_cache.get((scope, 'data'), force_refresh=force_refresh)
+    except KeyError:
+        db = None
+    return db if db else {"database": {}}
+
+def get_database_with_meta(force_refresh=False, scope_key=None):
+    """(db, meta): the decoded scope plus where it came from and how old it
+    is. db is None when nothing could be loaded (RTDB down, cold cache);
+    raises KeyError when the scope has no data node."""
+    scope = normalize_scope_key(scope_key)
+    if stream_state['connected'] and not force_refresh:
+        with stream_lock:
+            db = stream_snapshot_by_scope.get(scope)
+        if db is not None:
+            return db, {'source': 'stream', 'stale': False, 'ageSeconds': 0}
+    db = scope_cache.get((scope, 'data'), force_refresh=force_refresh)
+    return db, dict(scope_cache.meta((scope, 'data')), source='cache')
+
+def subtree_paths(scope_key, keys):
+    """Paths to fetch so that `keys` of a scope's data are cached"""
+    if not keys:
+        return []
+    if scope_shapes.get(scope_key) == 'tree':
+        return [f"data/{k}" for k in keys]
+    return ['data']
+
+def get_scope_subtrees(scope_key, keys, force_refresh=False, cached_only=False):
+    """Only the declared top-level `keys` of a scope's data, e.g.
+    get_scope_subtrees(scope, ('activePoll', 'quickLinks')). Missing keys
+    are left out of the result. With cached_only nothing is fetched, and
+    None is returned if any needed node has never been loaded."""
+    scope = normalize_scope_key(scope_key)
+    if not keys:
+        return {}
+    db = None
+    if stream_state['connected']:
+        with stream_lock:
+            db = stream_snapshot_by_scope.get(scope)
+    if db is None and scope_shapes.get(scope) == 'tree':
+        if cached_only:
+            entries = {k: scope_cache.peek_entry((scope, f"data/{k}")) for k in keys}
+            if not all(entries.values()):
+                return None
+            values = {k: e['value'] for k, e in entries.items()}
+        else:
+            values = {k: scope_cache.get((scope, f"data/{k}"), force_refresh=force_refresh) for k in keys}
+        return {k: v for k, v in values.items() if v is not None}
+    if db is None and cached_only:
+        entry = scope_cache.peek_entry((scope, 'data'))
+        if not entry:
+            return None
+        db = entry['value']
+    if db is None:
+        db = get_database_sync(force_refresh, scope)
+    return {k: db[k] for k in keys if db.get(k) is not None}
+
+def get_user_tokens(scope_key=None):
+    """userTokens of a scope, kept current by the stream or a conditional GET"""
+    scope = normalize_scope_key(scope_key)
+    return scope_cache.get((scope, 'userTokens')) or {}
+
+def get_schedule_triggers(scope_key=None):
+    scope = normalize_scope_key(scope_key)
+    return scope_cache.get((scope, 'scheduleTriggers')) or {}
 
 def get_all_scope_keys():
     try:
-        import requests
-        resp = requests.get(f"{FIREBASE_DB_URL}/scopes.json", timeout=10)
+        # shallow=true returns {scopeKey: true} instead of every scope document
+        resp = rtdb_request('GET', f"{FIREBASE_DB_URL}/scopes.json", hedge=True, op='list_scopes', params={'shallow': 'true'})
         if resp.status_code != 200:
             return [DEFAULT_SCOPE_KEY]
+        count_fetch(requests=1, bytes_fetched=len(resp.content))
         data = resp.json() or {}
         if isinstance(data, dict) and data:
             return list(data.keys())
@@ -144,163 +1088,656 @@ def get_all_scope_keys():
     return [DEFAULT_SCOPE_KEY]
 
 # ==========================================
-# 6. Helper: send FCM to all tokens
+# 6. Helper: FCM dispatch
 # ==========================================
-def clean_invalid_tokens(user_tokens, token_results, all_tokens, scope_key=None):
-    """Remove invalid/expired tokens from Firebase"""
-    try:
-        import requests
-        invalid_tokens = set()
-        for i, result in enumerate(token_results):
-            if not result.success:
-                err = str(result.exception)
-                if 'registration-token-not-registered' in err or 'invalid-registration-token' in err or 'InvalidRegistration' in err:
-                    if i < len(all_tokens):
-                        invalid_tokens.add(all_tokens[i])
-
-        if not invalid_tokens:
-            return
+# send_each() accepts at most 500 messages per call, so tokens are split
+# into batches that are sent concurrently on a bounded pool. send_each()
+# itself fans a batch out over one thread per message, hence the small
+# worker count.
+FCM_ICON = 'https://peacemaker3050-ux.github.io/2ndMec/icon-512.png'
+FCM_BATCH_SIZE = 500
+FCM_SEND_WORKERS = 4
+fcm_executor = ThreadPoolExecutor(max_workers=FCM_SEND_WORKERS, thread_name_prefix='fcm')
 
-        print(f"🧹 Cleaning {len(invalid_tokens)} invalid tokens...")
-        for safe_email, user_data in user_tokens.items():
-            if isinstance(user_data, dict):
-                old_tokens = user_data.get('tokens', [])
-                new_tokens = [t for t in old_tokens if t not in invalid_tokens]
-                if len(new_tokens) != len(old_tokens):
-                    user_data['tokens'] = new_tokens
-                    requests.put(
-                        f"{scoped_db_base(scope_key)}/userTokens/{safe_email}.json",
-                        json=user_data, timeout=10
-                    )
-                    print(f"🧹 Cleaned tokens for {safe_email}")
-    except Exception as e:
-        print(f"Clean tokens error: {e}")
+def build_message_template(title, body):
+    """Notification/platform config shared by every message of one send"""
+    return {
+        'notification': messaging.Notification(
+            title=title,
+            body=body,
+            image=FCM_ICON
+        ),
+        'android': messaging.AndroidConfig(
+            priority='high',
+            notification=messaging.AndroidNotification(
+                icon=FCM_ICON,
+                color='#3b82f6'
+            )
+        ),
+        'apns': messaging.APNSConfig(headers={'apns-priority': '10'}),
+        'webpush': messaging.WebpushConfig(
+            notification=messaging.WebpushNotification(
+                icon=FCM_ICON,
+                badge=FCM_ICON
+            )
+        ),
+    }
+
+def timed_send_each(messages):
+    firebase_app()
+    fcm_batch_size.observe(len(messages))
+    with fcm_send_each_seconds.time():
+        return messaging.send_each(messages).responses
 
-def send_fcm_all(title, body, scope_key=None):
+def send_fcm_batch(tokens, template):
     try:
-        import requests
-        print(f"📤 send_fcm_all called: {title} | {body}")
-        resp = requests.get(f"{scoped_db_base(scope_key)}/userTokens.json", timeout=10)
-        print(f"📤 userTokens status: {resp.status_code}")
-        if resp.status_code != 200:
-            return 0, 0
-        user_tokens = resp.json()
-        print(f"📤 userTokens raw: {list(user_tokens.keys()) if user_tokens else 'EMPTY'}")
-        if not user_tokens:
-            return 0, 0
-        tokens = []
-        for user_data in user_tokens.values():
-            if isinstance(user_data, list):
-                tokens.extend(user_data)
-            elif isinstance(user_data, dict):
+        messages = [messaging.Message(token=token, **template) for token in tokens]
+        return call_with_resilience('fcm', lambda: timed_send_each(messages), retries=1)
+    except Exception as e:
+        print(f"FCM Batch Error ({len(tokens)} tokens): {e}")
+        return [messaging.SendResponse(None, e) for _ in tokens]
+
+def dispatch_fcm(tokens, title, body):
+    """Send one notification to every token.
+
+    Returns (success, failure, responses) with `responses` aligned to `tokens`.
+    """
+    template = build_message_template(title, body)
+    batches = [tokens[i:i + FCM_BATCH_SIZE] for i in range(0, len(tokens), FCM_BATCH_SIZE)]
+    responses = []
+    for batch_responses in fcm_executor.map(lambda batch: send_fcm_batch(batch, template), batches):
+        responses.extend(batch_responses)
+    success = sum(1 for r in responses if r.success)
+    return success, len(responses) - success, responses
+
+def all_user_tokens(user_tokens):
+    tokens = []
+    for user_data in (user_tokens or {}).values():
+        if isinstance(user_data, list):
+            tokens.extend(user_data)
+        elif isinstance(user_data, dict):
+            tokens.extend(user_data.get('tokens', []))
+    return tokens
+
+def new_files_tokens(user_tokens):
+    tokens = []
+    for user_data in (user_tokens or {}).values():
+        if isinstance(user_data, dict):
+            if user_data.get('newFilesEnabled', False):
                 tokens.extend(user_data.get('tokens', []))
-        print(f"📤 Total tokens found: {len(tokens)}")
-        if not tokens:
-            print("📤 No tokens — aborting")
-            return 0, 0
-        messages = [
-            messaging.Message(
-                notification=messaging.Notification(
-                    title=title,
-                    body=body,
-                    image='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png'
-                ),
-                android=messaging.AndroidConfig(
-                    priority='high',
-                    notification=messaging.AndroidNotification(
-                        icon='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png',
-                        color='#3b82f6'
-                    )
-                ),
-                apns=messaging.APNSConfig(headers={'apns-priority': '10'}),
-                webpush=messaging.WebpushConfig(
-                    notification=messaging.WebpushNotification(
-                        icon='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png',
-                        badge='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png'
-                    )
-                ),
-                token=token
-            ) for token in tokens
-        ]
-        response = messaging.send_each(messages)
-        success = sum(1 for r in response.responses if r.success)
-        failure = len(response.responses) - success
-        print(f"FCM All: {success} success, {failure} failure")
-        for i, r in enumerate(response.responses):
-            if not r.success:
-                print(f"❌ Token[{i}] failed: {r.exception}")
-        if failure > 0:
-            clean_invalid_tokens(user_tokens, response.responses, tokens, scope_key)
-        return success, failure
+    return tokens
+
+# ==========================================
+# 7. Helper: FCM topic delivery
+# ==========================================
+# With FCM_DELIVERY_MODE=topic every token of a scope is subscribed to a
+# per-scope topic (and opted-in tokens to a newFiles topic), so a
+# broadcast is one topic send. Subscriptions are diffed against userTokens
+# whenever the sweep or the stream sees it change. Until a scope's first
+# sync completes its sends fall back to per-token delivery. The subscribed
+# sets are saved to TOPIC_STATE_PATH and read back on the first sync, so
+# tokens dropped while the process was down still get unsubscribed.
+# Network calls hold only their topic's lock.
+FCM_DELIVERY_MODE = os.environ.get("FCM_DELIVERY_MODE", "tokens")
+FCM_TOPIC_BATCH_SIZE = 1000
+TOPIC_STATE_PATH = os.environ.get("TOPIC_STATE_PATH", os.path.join(tempfile.gettempdir(), "unibot-topics.json"))
+topic_subscriptions = {}   # topic -> frozenset of subscribed tokens
+topic_ready_scopes = set()
+topic_lock = threading.Lock()  # guards the dicts and the state file, never held across a call to FCM
+topic_locks = {}  # topic -> lock held while its membership is updated
+topic_state_loaded = [False]
+
+def scope_topic(scope_key, new_files=False):
+    # Topic names only allow [a-zA-Z0-9-_.~%], scope keys are free text
+    digest = hashlib.sha1(normalize_scope_key(scope_key).encode('utf-8')).hexdigest()[:20]
+    return f"{'newfiles' if new_files else 'scope'}-{digest}"
+
+def topic_delivery_ready(scope_key):
+    return FCM_DELIVERY_MODE == 'topic' and normalize_scope_key(scope_key) in topic_ready_scopes
+
+def send_fcm_topic(topic, title, body):
+    firebase_app()
+    message = messaging.Message(topic=topic, **build_message_template(title, body))
+    call_with_resilience('fcm', lambda: messaging.send(message), retries=1)
+    print(f"FCM Topic {topic}: sent")
+    return 1, 0
+
+def update_topic_membership(topic, tokens, subscribe):
+    """(Un)subscribe tokens in 1000-token batches; returns the ones that succeeded"""
+    firebase_app()
+    call = messaging.subscribe_to_topic if subscribe else messaging.unsubscribe_from_topic
+    done = set()
+    for i in range(0, len(tokens), FCM_TOPIC_BATCH_SIZE):
+        batch = tokens[i:i + FCM_TOPIC_BATCH_SIZE]
+        response = call_with_resilience('fcm', lambda: call(batch, topic))
+        failed = {batch[err.index] for err in response.errors}
+        done.update(t for t in batch if t not in failed)
+    return done
+
+def load_topic_subscriptions():
+    with topic_lock:
+        if topic_state_loaded[0]:
+            return
+        for topic, tokens in (read_json_file(TOPIC_STATE_PATH, {}) or {}).items():
+            topic_subscriptions.setdefault(topic, frozenset(tokens))
+        topic_state_loaded[0] = True
+
+def save_topic_subscriptions():
+    try:
+        with topic_lock:
+            write_json_file(TOPIC_STATE_PATH, {t: sorted(s) for t, s in topic_subscriptions.items() if s}, private=True)
     except Exception as e:
-        print(f"FCM Error: {e}")
+        print(f"📡 Topic state save error: {e}")
+
+def sync_scope_topics(scope_key, user_tokens):
+    scope = normalize_scope_key(scope_key)
+    wanted_by_topic = {
+        scope_topic(scope): set(all_user_tokens(user_tokens)),
+        scope_topic(scope, new_files=True): set(new_files_tokens(user_tokens)),
+    }
+    load_topic_subscriptions()
+    changed = False
+    for topic, wanted in wanted_by_topic.items():
+        with topic_lock:
+            membership_lock = topic_locks.setdefault(topic, threading.Lock())
+        with membership_lock:
+            with topic_lock:
+                current = set(topic_subscriptions.get(topic, ()))
+            added = sorted(wanted - current)
+            removed = sorted(current - wanted)
+            if added:
+                current |= update_topic_membership(topic, added, subscribe=True)
+            if removed:
+                current -= update_topic_membership(topic, removed, subscribe=False)
+            if added or removed:
+                with topic_lock:
+                    topic_subscriptions[topic] = frozenset(current)
+                changed = True
+                print(f"📡 Topic {topic} [{scope}]: +{len(added)} -{len(removed)}")
+    if changed:
+        save_topic_subscriptions()
+    with topic_lock:
+        topic_ready_scopes.add(scope)
+
+def topic_sync_watcher(scope_key, db):
+    sync_scope_topics(scope_key, get_user_tokens(scope_key))
+
+# ==========================================
+# 8. Helper: token registry & invalid-token cleanup
+# ==========================================
+# Per scope: user -> (tokens, newFilesEnabled, stored-as-list) and
+# token -> users, updated from every userTokens snapshot the sweep, the
+# stream or get_user_tokens() sees. Only users whose entry changed are
+# re-indexed. Sends read de-duplicated tokens from here, and invalid
+# tokens are queued and removed in one multi-location PATCH per scope by
+# token_cleanup_watcher, outside the send path, built from a fresh read
+# of the scope's userTokens.
+TOKEN_CLEANUP_INTERVAL = 30
+token_registry = {}
+token_registry_lock = threading.Lock()
+invalid_tokens_by_scope = {}
+invalid_tokens_lock = threading.Lock()
+
+def set_registry_user(reg, email, record):
+    old = reg['users'].pop(email, None)
+    for token in (old[0] if old else ()):
+        owners = reg['owners'].get(token)
+        if owners:
+            owners.discard(email)
+            if not owners:
+                del reg['owners'][token]
+    if record:
+        reg['users'][email] = record
+        for token in record[0]:
+            reg['owners'].setdefault(token, set()).add(email)
+
+def update_token_registry(scope_key, user_tokens):
+    records = {}
+    for email, user_data in (user_tokens or {}).items():
+        if isinstance(user_data, list):
+            records[email] = (tuple(user_data), False, True)
+        elif isinstance(user_data, dict):
+            records[email] = (tuple(user_data.get('tokens') or ()), bool(user_data.get('newFilesEnabled', False)), False)
+    with token_registry_lock:
+        reg = token_registry.setdefault(normalize_scope_key(scope_key), {'users': {}, 'owners': {}})
+        for email in set(reg['users']) | set(records):
+            if reg['users'].get(email) != records.get(email):
+                set_registry_user(reg, email, records.get(email))
+
+def registry_tokens(scope_key, new_files=False):
+    """Unique tokens of a scope, optionally only those of newFiles opt-ins"""
+    get_user_tokens(scope_key)  # refreshes the registry when the cache is cold
+    with token_registry_lock:
+        reg = token_registry.get(normalize_scope_key(scope_key))
+        if not reg:
+            return []
+        if not new_files:
+            return list(reg['owners'])
+        return [t for t, emails in reg['owners'].items() if any(reg['users'][e][1] for e in emails)]
+
+def is_invalid_token_error(exception):
+    """FCM's verdict that a token will never work again"""
+    if isinstance(exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+        return True
+    # INVALID_ARGUMENT also covers bad payloads; only drop the token if it is the culprit
+    return isinstance(exception, firebase_exceptions.InvalidArgumentError) and 'token' in str(exception).lower()
+
+def queue_invalid_tokens(token_results, all_tokens, scope_key=None):
+    """Queue tokens FCM rejected as unregistered/invalid for the next flush"""
+    invalid = {
+        all_tokens[i] for i, result in enumerate(token_results)
+        if not result.success and i < len(all_tokens) and is_invalid_token_error(result.exception)
+    }
+    if invalid:
+        with invalid_tokens_lock:
+            invalid_tokens_by_scope.setdefault(normalize_scope_key(scope_key), set()).update(invalid)
+
+def flush_invalid_tokens():
+    with invalid_tokens_lock:
+        pending = dict(invalid_tokens_by_scope)
+        invalid_tokens_by_scope.clear()
+    for scope, invalid in pending.items():
+        try:
+            # Re-read userTokens right before writing: the registry can be
+            # minutes old, and a token registered since must not be erased
+            resp = rtdb_request('GET', f"{scoped_db_base(scope)}/userTokens.json", op='get_userTokens', scope=scope)
+            if resp.status_code != 200:
+                raise RuntimeError(f"HTTP {resp.status_code}")
+            user_tokens = json_loads(resp.content) or {}
+            updates = {}
+            for email, user_data in user_tokens.items():
+                if isinstance(user_data, list):
+                    kept = [t for t in user_data if t not in invalid]
+                    if len(kept) != len(user_data):
+                        updates[f"userTokens/{email}"] = user_tokens[email] = kept
+                elif isinstance(user_data, dict):
+                    tokens = user_data.get('tokens') or []
+                    kept = [t for t in tokens if t not in invalid]
+                    if len(kept) != len(tokens):
+                        updates[f"userTokens/{email}/tokens"] = user_data['tokens'] = kept
+            if updates:
+                resp = rtdb_request('PATCH', f"{scoped_db_base(scope)}/.json", op='clean_tokens', scope=scope, json=updates)
+                if resp.status_code != 200:
+                    raise RuntimeError(f"HTTP {resp.status_code}")
+                print(f"🧹 Cleaned {len(invalid)} invalid tokens across {len(updates)} users [{scope}]")
+            update_token_registry(scope, user_tokens)
+        except Exception as e:
+            print(f"Clean tokens error [{scope}]: {e}")
+            with invalid_tokens_lock:
+                invalid_tokens_by_scope.setdefault(scope, set()).update(invalid)
+
+def token_cleanup_watcher():
+    print("🧹 Token Cleanup Watcher started")
+    # Every worker starts at once after a deploy; spread their flushes
+    time.sleep(random.uniform(0, TOKEN_CLEANUP_INTERVAL))
+    while True:
+        try:
+            flush_invalid_tokens()
+        except Exception as e:
+            print(f"Token Cleanup Watcher Error: {e}")
+        time.sleep(TOKEN_CLEANUP_INTERVAL)
+
+# ==========================================
+# 9. Helper: send FCM to a scope
+# ==========================================
+def deliver_fcm(title, body, scope_key=None, new_files=False):
+    """Send one notification to a scope (or its new-files audience).
+
+    Returns (success, failure). Raises when nothing was delivered for a
+    reason worth retrying (FCM unreachable, circuit open).
+    """
+    label = "FCM New Files" if new_files else "FCM All"
+    if topic_delivery_ready(scope_key):
+        return send_fcm_topic(scope_topic(scope_key, new_files=new_files), title, body)
+    tokens = registry_tokens(scope_key, new_files=new_files)
+    print(f"📤 {label}: {len(tokens)} tokens")
+    if not tokens:
         return 0, 0
+    success, failure, responses = dispatch_fcm(tokens, title, body)
+    fcm_messages_total.inc(success, outcome='success')
+    fcm_messages_total.inc(failure, outcome='failure')
+    reasons = {}
+    for r in responses:
+        if not r.success:
+            reason = type(r.exception).__name__
+            reasons[reason] = reasons.get(reason, 0) + 1
+    for reason, n in reasons.items():
+        fcm_token_failures_total.inc(n, reason=reason)
+    print(f"{label}: {success} success, {failure} failure" +
+          (f" ({', '.join(f'{n} {r}' for r, n in sorted(reasons.items()))})" if reasons else ""))
+    if failure > 0:
+        queue_invalid_tokens(responses, tokens, scope_key)
+    if not success and any(isinstance(r.exception, CircuitOpenError) or is_transient(r.exception) for r in responses):
+        raise RuntimeError(f"{label}: no token reached ({responses[0].exception})")
+    return success, failure
 
 # ==========================================
-# 7. Helper: send FCM to new-files-enabled tokens only
+# 10. Notification outbox
 # ==========================================
-def send_fcm_new_files(title, body, scope_key=None):
+# Pushes are written to a SQLite outbox and returned to the caller at once;
+# OUTBOX_WORKERS threads in the watcher leader deliver them, one message
+# per scope at a time and at most one every OUTBOX_SCOPE_INTERVAL seconds
+# per scope. A failed delivery is retried with backoff up to
+# OUTBOX_MAX_ATTEMPTS. An idempotency key (client-supplied, or derived
+# from the event for watchers) makes a repeated submission return the
+# existing message instead of sending twice. Rows stuck in 'sending' after
+# a leader crash are re-queued by the next leader (at-least-once).
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", os.path.join(tempfile.gettempdir(), "unibot-outbox.sqlite3"))
+OUTBOX_WORKERS = 4
+OUTBOX_SCOPE_INTERVAL = 2
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_RETENTION = 7 * 86400
+outbox_local = threading.local()
+outbox_lock = threading.Lock()
+outbox_wake = threading.Event()
+outbox_busy_scopes = set()
+outbox_last_sent = {}
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT UNIQUE,
+    scope_key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    success INTEGER,
+    failure INTEGER,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, not_before, created_at);
+"""
+
+def outbox_db():
+    # One connection per thread; WAL lets readers in other workers proceed
+    conn = getattr(outbox_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(OUTBOX_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(OUTBOX_SCHEMA)
+        outbox_local.conn = conn
+    return conn
+
+def event_key(*parts):
+    """Idempotency key for a watcher event"""
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+def enqueue_notification(title, body, scope_key=None, new_files=False, idempotency_key=None):
+    """Queue a push; returns (message_id, duplicate)"""
+    scope = normalize_scope_key(scope_key)
+    message_id = uuid.uuid4().hex
+    now = time.time()
+    conn = outbox_db()
     try:
-        import requests
-        resp = requests.get(f"{scoped_db_base(scope_key)}/userTokens.json", timeout=10)
-        if resp.status_code != 200:
-            return 0, 0
-        user_tokens = resp.json()
-        if not user_tokens:
-            return 0, 0
-        tokens = []
-        for user_data in user_tokens.values():
-            if isinstance(user_data, dict):
-                if user_data.get('newFilesEnabled', False):
-                    tokens.extend(user_data.get('tokens', []))
-        if not tokens:
-            print("FCM New Files: No opted-in tokens")
-            return 0, 0
-        messages = [
-            messaging.Message(
-                notification=messaging.Notification(
-                    title=title,
-                    body=body,
-                    image='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png'
-                ),
-                android=messaging.AndroidConfig(
-                    priority='high',
-                    notification=messaging.AndroidNotification(
-                        icon='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png',
-                        color='#3b82f6'
-                    )
-                ),
-                apns=messaging.APNSConfig(headers={'apns-priority': '10'}),
-                webpush=messaging.WebpushConfig(
-                    notification=messaging.WebpushNotification(
-                        icon='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png',
-                        badge='https://peacemaker3050-ux.github.io/2ndMec/icon-512.png'
-                    )
-                ),
-                token=token
-            ) for token in tokens
-        ]
-        response = messaging.send_each(messages)
-        success = sum(1 for r in response.responses if r.success)
-        failure = len(response.responses) - success
-        print(f"FCM New Files: {success} success, {failure} failure")
-        for i, r in enumerate(response.responses):
-            if not r.success:
-                print(f"FCM Fail token[{i}]: {r.exception}")
-        if failure > 0:
-            clean_invalid_tokens(user_tokens, response.responses, tokens, scope_key)
-        return success, failure
+        conn.execute(
+            "INSERT INTO outbox (id, idempotency_key, scope_key, kind, title, body, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (message_id, idempotency_key, scope, 'new_files' if new_files else 'all', title, body, now, now)
+        )
+    except sqlite3.IntegrityError:
+        row = conn.execute("SELECT id FROM outbox WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+        if row:
+            print(f"📥 Duplicate notification dropped [{scope}]: {title}")
+            return row['id'], True
+        raise
+    outbox_wake.set()
+    print(f"📥 Notification queued [{scope}]: {title}")
+    return message_id, False
+
+def notification_status(message_id):
+    row = outbox_db().execute("SELECT * FROM outbox WHERE id = ?", (message_id,)).fetchone()
+    if not row:
+        return None
+    return {
+        "messageId": row['id'],
+        "status": row['status'],
+        "scopeKey": row['scope_key'],
+        "kind": row['kind'],
+        "title": row['title'],
+        "attempts": row['attempts'],
+        "success": row['success'],
+        "failure": row['failure'],
+        "error": row['error'],
+        "createdAt": int(row['created_at'] * 1000),
+        "updatedAt": int(row['updated_at'] * 1000),
+    }
+
+def outbox_stats():
+    try:
+        rows = outbox_db().execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
     except Exception as e:
-        print(f"FCM New Files Error: {e}")
-        return 0, 0
+        return {"error": str(e)}
+
+def claim_notification():
+    """Mark the oldest deliverable message 'sending' and return it"""
+    now = time.time()
+    with outbox_lock:
+        blocked = outbox_busy_scopes | {s for s, t in outbox_last_sent.items() if now - t < OUTBOX_SCOPE_INTERVAL}
+        conn = outbox_db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM outbox WHERE status = 'queued' AND not_before <= ? "
+                f"AND scope_key NOT IN ({','.join('?' * len(blocked))}) ORDER BY created_at LIMIT 1",
+                (now, *blocked)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                             (now, row['id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row:
+            outbox_busy_scopes.add(row['scope_key'])
+    return row
+
+def deliver_outbox_message(row):
+    scope = row['scope_key']
+    attempts = row['attempts'] + 1
+    conn = outbox_db()
+    try:
+        with outbox_delivery_seconds.time(kind=row['kind']):
+            success, failure = deliver_fcm(row['title'], row['body'], scope, new_files=row['kind'] == 'new_files')
+        conn.execute("UPDATE outbox SET status = 'sent', success = ?, failure = ?, error = NULL, updated_at = ? WHERE id = ?",
+                     (success, failure, time.time(), row['id']))
+        outbox_queue_seconds.observe(time.time() - row['created_at'], kind=row['kind'])
+    except Exception as e:
+        print(f"📥 Outbox delivery error [{scope}] (attempt {attempts}): {e}")
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            conn.execute("UPDATE outbox SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                         (str(e), time.time(), row['id']))
+        else:
+            delay = min(300, OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+            conn.execute("UPDATE outbox SET status = 'queued', error = ?, not_before = ?, updated_at = ? WHERE id = ?",
+                         (str(e), time.time() + delay, time.time(), row['id']))
+    finally:
+        with outbox_lock:
+            outbox_busy_scopes.discard(scope)
+            outbox_last_sent[scope] = time.time()
+        outbox_wake.set()  # this scope may have more waiting
+
+def outbox_worker():
+    while True:
+        try:
+            row = claim_notification()
+        except Exception as e:
+            print(f"📥 Outbox Worker Error: {e}")
+            row = None
+        if row is None:
+            # Inserts from other workers are only seen by polling
+            outbox_wake.wait(1)
+            outbox_wake.clear()
+            continue
+        deliver_outbox_message(row)
+
+def start_outbox():
+    conn = outbox_db()
+    requeued = conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'").rowcount
+    pruned = conn.execute("DELETE FROM outbox WHERE status IN ('sent', 'failed') AND updated_at < ?",
+                          (time.time() - OUTBOX_RETENTION,)).rowcount
+    print(f"📥 Outbox ready: {requeued} re-queued, {pruned} pruned")
+    for _ in range(OUTBOX_WORKERS):
+        threading.Thread(target=outbox_worker, daemon=True).start()
 
 # ==========================================
-# 8. API Routes
+# 11. API Routes
 # ==========================================
 
 @app_flask.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "ok", "service": "UniBot API"})
+    return jsonify({"status": "ok", "service": "UniBot API", "pid": os.getpid(), "watcherLeader": leader_state['leader']})
+
+@app_flask.route('/stats', methods=['GET'])
+def stats():
+    with fetch_stats_lock:
+        fetch = dict(fetch_stats)
+    return jsonify({"fetch": fetch, "cache": scope_cache.stats(), "resilience": resilience_stats(),
+                    "outbox": outbox_stats(), "render": dict(render_stats)})
+
+# --- Metrics endpoint ---
+GaugeCollector('unibot_process_info', 'This worker process', ('pid', 'leader'),
+               lambda: {(os.getpid(), leader_state['leader']): 1})
+GaugeCollector('unibot_scope_cache_events_total', 'Scope cache events since start', ('event',),
+               lambda: {(k,): v for k, v in scope_cache.stats().items() if k not in ('entries', 'bytes')},
+               kind='counter')
+GaugeCollector('unibot_scope_cache_size', 'Scope cache entries and bytes', ('unit',),
+               lambda: {(k,): v for k, v in scope_cache.stats().items() if k in ('entries', 'bytes')})
+GaugeCollector('unibot_fetch_total', 'RTDB egress counters since start', ('counter',),
+               lambda: {(k,): v for k, v in dict(fetch_stats).items()}, kind='counter')
+GaugeCollector('unibot_circuit_open', 'Circuit breaker state (1 = open or half-open)', ('endpoint',),
+               lambda: {(n,): int(b.stats()['state'] != 'closed') for n, b in breakers.items()})
+GaugeCollector('unibot_outbox_messages', 'Outbox messages by status', ('status',),
+               lambda: {(k,): v for k, v in outbox_stats().items() if k != 'error'})
+GaugeCollector('unibot_stream_connected', 'RTDB event stream connected', (),
+               lambda: {(): int(stream_state['connected'])})
+
+@app_flask.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- Cached read API ---
+# GET /scope/<scopeKey>[/<path>] serves the decoded `data` document (or a
+# subtree of it, e.g. /scope/<key>/quickLinks) from the scope cache, so
+# clients stop downloading the whole scope from RTDB on every app open.
+# A scope without a `data` node is a 404 and leaves nothing in the cache;
+# a scope that could not be loaded at all is a 503, never an empty 200.
+# A decoded snapshot is a shared, never-mutated object, so its identity
+# is its version: the JSON body, strong ETag and gzip/brotli encodings
+# are built once per snapshot and path, then reused until it is replaced.
+RENDER_CACHE_MAX_BYTES = 128 * 1024 * 1024
+SCOPE_RETRY_AFTER = 5  # seconds, on a 503
+render_cache = OrderedDict()  # (scope, path) -> rendition
+render_cache_lock = threading.Lock()
+render_stats = {'renders': 0, 'hits': 0, 'not_modified': 0, 'bytes': 0}
+
+def subtree_at(db, parts):
+    node = db
+    for part in parts:
+        if isinstance(node, dict) and part in node:
+            node = node[part]
+        elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+            node = node[int(part)]
+        else:
+            raise KeyError(part)
+    return node
+
+def render_subtree(scope, parts, db):
+    key = (scope, '/'.join(parts))
+    with render_cache_lock:
+        rendition = render_cache.get(key)
+        if rendition and rendition['source'] is db:
+            render_cache.move_to_end(key)
+            render_stats['hits'] += 1
+            return rendition
+    body = json.dumps(subtree_at(db, parts), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    rendition = {
+        'source': db,  # keeps the snapshot alive, so `is` stays a valid version check
+        'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+        'encodings': {'identity': body},
+        'size': len(body),
+    }
+    with render_cache_lock:
+        old = render_cache.pop(key, None)
+        if old:
+            render_stats['bytes'] -= old['size']
+        render_cache[key] = rendition
+        render_stats['bytes'] += rendition['size']
+        render_stats['renders'] += 1
+        while len(render_cache) > 1 and render_stats['bytes'] > RENDER_CACHE_MAX_BYTES:
+            _, evicted = render_cache.popitem(last=False)
+            render_stats['bytes'] -= evicted['size']
+    return rendition
+
+def encoded_body(rendition, encoding):
+    encodings = rendition['encodings']
+    if encoding not in encodings:
+        body = encodings['identity']
+        encoded = brotli.compress(body, quality=5) if encoding == 'br' else gzip.compress(body, compresslevel=6)
+        with render_cache_lock:
+            encodings[encoding] = encoded
+            rendition['size'] += len(encoded)
+            render_stats['bytes'] += len(encoded)
+    return encodings[encoding]
+
+def pick_encoding(accept_encoding):
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return 'identity'
+
+def etag_matches(if_none_match, etag):
+    tags = [t.strip() for t in (if_none_match or '').split(',')]
+    return '*' in tags or etag in tags
+
+@app_flask.route('/scope/<scope_key>', methods=['GET'])
+@app_flask.route('/scope/<scope_key>/<path:subpath>', methods=['GET'])
+def scope_read(scope_key, subpath=''):
+    scope = normalize_scope_key(scope_key)
+    parts = [p for p in subpath.split('/') if p]
+    try:
+        db, meta = get_database_with_meta(scope_key=scope)
+        if db is None:
+            return jsonify({"error": "Scope temporarily unavailable"}), 503, {'Retry-After': str(SCOPE_RETRY_AFTER)}
+        rendition = render_subtree(scope, parts, db)
+    except KeyError:
+        return jsonify({"error": "Not found"}), 404
+    except Exception as e:
+        print(f"Scope read error [{scope}/{subpath}]: {e}")
+        return jsonify({"error": str(e)}), 500
+    headers = {
+        'ETag': rendition['etag'],
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+        'X-Data-Source': meta.get('source', 'cache'),
+        'X-Data-Age': str(meta.get('ageSeconds', 0)),
+    }
+    if meta.get('stale'):
+        headers['Warning'] = '110 - "Response is Stale"'
+    if etag_matches(request.headers.get('If-None-Match'), rendition['etag']):
+        render_stats['not_modified'] += 1
+        return Response(status=304, headers=headers)
+    encoding = pick_encoding(request.headers.get('Accept-Encoding'))
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(encoded_body(rendition, encoding), status=200, headers=headers,
+                    content_type='application/json; charset=utf-8')
 
 # --- Send notification to all users ---
 @app_flask.route('/send-notification', methods=['POST'])
@@ -313,14 +1750,29 @@ def send_notification():
     scope_key = data.get('scopeKey') or DEFAULT_SCOPE_KEY
     if not title or not body:
         return jsonify({"error": "title and body required"}), 400
-    success, failure = send_fcm_all(title, body, scope_key=scope_key)
-    return jsonify({"success": success, "failure": failure})
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+    promote_scope(scope_key)
+    try:
+        message_id, duplicate = enqueue_notification(title, body, scope_key, idempotency_key=idempotency_key)
+    except Exception as e:
+        print(f"Outbox Error: {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"success": True, "messageId": message_id, "duplicate": duplicate,
+                    "status": notification_status(message_id)['status']}), 202
+
+@app_flask.route('/notification-status/<message_id>', methods=['GET'])
+def notification_status_route(message_id):
+    status = notification_status(message_id)
+    if not status:
+        return jsonify({"error": "Unknown message"}), 404
+    return jsonify(status)
 
 # --- Helper: get or create folder by name inside a parent ---
 def get_or_create_folder(service, name, parent_id):
     # Search for existing folder
-    query = f"name='{name}' and '{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
+    safe_name = name.replace('\\', '\\\\').replace("'", "\\'")
+    query = f"name='{safe_name}' and '{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
+    results = drive_execute(service.files().list(q=query, fields="files(id, name)"), 'folder_lookup')
     files = results.get('files', [])
     if files:
         print(f"📁 Found folder: {name} ({files[0]['id']})")
@@ -331,10 +1783,380 @@ def get_or_create_folder(service, name, parent_id):
         'mimeType': 'application/vnd.google-apps.folder',
         'parents': [parent_id]
     }
-    folder = service.files().create(body=metadata, fields='id').execute()
+    folder = drive_execute(service.files().create(body=metadata, fields='id'), 'folder_create', retries=0)
     print(f"📁 Created folder: {name} ({folder['id']})")
     return folder['id']
 
+# --- Helper: folder path -> Drive ID cache ---
+# Resolved folder IDs are cached per path from the Drive root and kept on
+# local disk, so known paths cost no Drive calls. Entries are re-checked
+# for trashed/deleted folders every FOLDER_REVALIDATE_INTERVAL seconds.
+# Creating a folder happens under a per-path lock and the cache file lock,
+# after merging what other workers saved, so concurrent uploads to a new
+# path create it once across all processes.
+FOLDER_CACHE_PATH = os.environ.get("FOLDER_CACHE_PATH", "folder_cache.json")
+FOLDER_LOCK_PATH = f"{FOLDER_CACHE_PATH}.lock"
+FOLDER_REVALIDATE_INTERVAL = 6 * 3600
+folder_cache = {}
+folder_cache_lock = threading.Lock()
+folder_path_locks = {}
+
+def load_folder_cache():
+    saved = read_json_file(FOLDER_CACHE_PATH, {})
+    with folder_cache_lock:
+        folder_cache.update(saved)
+    return len(saved)
+
+def write_folder_cache(dropped=()):
+    """Merge this worker's entries into the cache file (FOLDER_LOCK_PATH held)"""
+    try:
+        saved = read_json_file(FOLDER_CACHE_PATH, {})
+        with folder_cache_lock:
+            for key in dropped:
+                saved.pop(key, None)
+            saved.update(folder_cache)
+            folder_cache.update(saved)
+        write_json_file(FOLDER_CACHE_PATH, saved)
+    except Exception as e:
+        print(f"📁 Folder cache save error: {e}")
+
+def save_folder_cache(dropped=()):
+    with file_lock(FOLDER_LOCK_PATH):
+        write_folder_cache(dropped)
+
+def folder_path_lock(path_key):
+    with folder_cache_lock:
+        return folder_path_locks.setdefault(path_key, threading.Lock())
+
+def invalidate_folder_path(path_key):
+    """Drop a cached folder and everything cached below it"""
+    with folder_cache_lock:
+        dropped = [k for k in folder_cache if k == path_key or k.startswith(path_key + '/')]
+        for key in dropped:
+            del folder_cache[key]
+    save_folder_cache(dropped)
+
+def invalidate_folder_chain(parts):
+    """Drop the cached folders of one upload path, from the scope folder
+    down; other scopes and sibling folders keep their entries"""
+    keys = {folder_path_key(parts[:i]) for i in range(2, len(parts) + 1)}
+    with folder_cache_lock:
+        dropped = [k for k in keys if k in folder_cache]
+        for key in dropped:
+            del folder_cache[key]
+    save_folder_cache(dropped)
+
+def folder_is_live(service, folder_id):
+    try:
+        meta = drive_execute(service.files().get(fileId=folder_id, fields='id, trashed'), 'folder_check')
+        return not meta.get('trashed', False)
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+
+def cached_folder(service, path_key, name, parent_id):
+    with folder_cache_lock:
+        entry = folder_cache.get(path_key)
+    if entry:
+        if time.time() - entry['checked_at'] < FOLDER_REVALIDATE_INTERVAL:
+            return entry['id']
+        if folder_is_live(service, entry['id']):
+            with folder_cache_lock:
+                entry['checked_at'] = time.time()
+            save_folder_cache()
+            return entry['id']
+        print(f"📁 Cached folder gone: {path_key}")
+        invalidate_folder_path(path_key)
+    with folder_path_lock(path_key), file_lock(FOLDER_LOCK_PATH):
+        load_folder_cache()  # another worker may have just created it
+        with folder_cache_lock:
+            entry = folder_cache.get(path_key)
+        if entry:
+            return entry['id']
+        folder_id = get_or_create_folder(service, name, parent_id)
+        with folder_cache_lock:
+            folder_cache[path_key] = {'id': folder_id, 'checked_at': time.time()}
+        write_folder_cache()
+        return folder_id
+
+def upload_folder_parts(scope_key, subject, doctor, folder_path):
+    # Root -> Scopes -> scopeKey -> Subject -> Doctor -> [subfolders]
+    parts = ["Scopes", scope_key]
+    if subject:
+        parts.append(subject)
+    if doctor:
+        parts.append(doctor)
+    # Handle extra subfolders e.g. "Lectures/Week1"
+    for part in (folder_path or '').split('/'):
+        part = part.strip()
+        if part:
+            parts.append(part)
+    return parts
+
+def folder_path_key(parts):
+    return '/'.join([DRIVE_FOLDER_ID] + parts)
+
+def resolve_folder_path(service, parts):
+    folder_id = DRIVE_FOLDER_ID
+    for i, name in enumerate(parts):
+        folder_id = cached_folder(service, folder_path_key(parts[:i + 1]), name, folder_id)
+    return folder_id
+
+print(f"📁 Folder cache loaded: {load_folder_cache()} paths")
+
+# --- Helper: chunked resumable upload ---
+# Media is read from a seekable stream UPLOAD_CHUNK_SIZE bytes at a time,
+# so memory per upload stays bounded whatever the file size. A failed
+# chunk is retried by the client library, which resumes the session from
+# the last byte Drive acknowledged.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # must be a multiple of 256 KB
+UPLOAD_CHUNK_RETRIES = 5
+
+def upload_stream(service, stream, filename, mimetype, parent_id, on_progress=None):
+    stream.seek(0)
+    media = MediaIoBaseUpload(
+        stream,
+        mimetype=mimetype or 'application/octet-stream',
+        chunksize=UPLOAD_CHUNK_SIZE,
+        resumable=True
+    )
+    upload = service.files().create(
+        body={'name': filename, 'parents': [parent_id]},
+        media_body=media,
+        fields='id, name, webViewLink, md5Checksum'
+    )
+    if DRIVE_API_ENDPOINT:
+        # The client library moves media URLs to the endpoint's host but keeps https
+        upload.uri = GOOGLE_API_ROOT.split('://')[0] + upload.uri[upload.uri.index('://'):]
+    total = media.size()
+    sent = 0
+    chunk = 0
+    response = None
+    while response is None:
+        started = time.perf_counter()
+        status, response = drive_call('upload_chunk', lambda: upload.next_chunk(num_retries=UPLOAD_CHUNK_RETRIES), retries=0)
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        now_sent = status.resumable_progress if status else total
+        chunk += 1
+        mb = (now_sent - sent) / (1024 * 1024)
+        sent = now_sent
+        print(f"⬆️ {filename} chunk {chunk}: {mb:.1f} MB in {elapsed:.2f}s ({mb / elapsed:.1f} MB/s) — {sent}/{total} bytes")
+        if on_progress:
+            on_progress(sent, total)
+    return response
+
+# --- Helper: content-hash deduplication ---
+# Each target folder gets an index of md5Checksum -> file, filled from
+# one paged files().list and updated after every upload. A re-upload of
+# identical content returns the existing file instead of transferring it
+# again. Striped locks serialise concurrent uploads of the same content
+# into the same folder, so they also dedupe against each other.
+FOLDER_INDEX_TTL = 600
+folder_md5_index = {}
+folder_md5_lock = threading.Lock()
+dedup_locks = [threading.Lock() for _ in range(64)]
+
+def stream_md5(stream, chunk_size=1024 * 1024):
+    """MD5 of a seekable stream, read in bounded chunks"""
+    stream.seek(0)
+    digest = hashlib.md5()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def folder_files_by_md5(service, folder_id):
+    with folder_md5_lock:
+        index = folder_md5_index.get(folder_id)
+        if index and time.time() - index['loaded_at'] < FOLDER_INDEX_TTL:
+            return index['files']
+    files = {}
+    page_token = None
+    while True:
+        results = drive_execute(service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false and mimeType!='application/vnd.google-apps.folder'",
+            fields="nextPageToken, files(id, name, md5Checksum, webViewLink)",
+            pageSize=1000,
+            pageToken=page_token
+        ), 'dedup_list')
+        for f in results.get('files', []):
+            if f.get('md5Checksum'):
+                files[f['md5Checksum']] = f
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    with folder_md5_lock:
+        folder_md5_index[folder_id] = {'loaded_at': time.time(), 'files': files}
+    return files
+
+def remember_folder_file(folder_id, uploaded, md5):
+    with folder_md5_lock:
+        index = folder_md5_index.get(folder_id)
+        if index:
+            index['files'][uploaded.get('md5Checksum') or md5] = uploaded
+
+# --- Helper: upload one file into its scope/subject/doctor folder ---
+def upload_to_folder(service, stream, filename, mimetype, folder_parts, folder_id, on_progress=None):
+    """Upload into `folder_id` unless it already holds the same content.
+
+    Returns (file, is_duplicate).
+    """
+    md5 = stream_md5(stream)
+    with dedup_locks[hash((folder_id, md5)) % len(dedup_locks)]:
+        existing = folder_files_by_md5(service, folder_id).get(md5)
+        if existing:
+            print(f"♻️ Duplicate of {existing.get('name')} ({existing['id']}): {filename}")
+            return existing, True
+        # Streamed from a spooled temp file instead of being read into memory
+        try:
+            uploaded = upload_stream(service, stream, filename, mimetype, folder_id, on_progress)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # A cached folder on this path was deleted since it was last checked
+            invalidate_folder_chain(folder_parts)
+            folder_id = resolve_folder_path(service, folder_parts)
+            uploaded = upload_stream(service, stream, filename, mimetype, folder_id, on_progress)
+        remember_folder_file(folder_id, uploaded, md5)
+        return uploaded, False
+
+def process_upload(stream, filename, mimetype, scope_key, subject, doctor, folder_path, notify, on_progress=None):
+    service = get_drive_service()
+
+    # Navigate/create folder structure (cached)
+    folder_parts = upload_folder_parts(scope_key, subject, doctor, folder_path)
+    current_folder_id = resolve_folder_path(service, folder_parts)
+
+    # Upload file into the final folder
+    uploaded, duplicate = upload_to_folder(service, stream, filename, mimetype, folder_parts, current_folder_id, on_progress)
+    drive_link = uploaded.get('webViewLink', '')
+    file_id    = uploaded.get('id', '')
+    # Whatever `notify` says, the new-files watcher must not announce it later
+    note_uploaded_files(scope_key, [filename])
+
+    if duplicate:
+        # Same content is already there: no transfer, no second push
+        return {
+            "success": True,
+            "duplicate": True,
+            "fileId": file_id,
+            "fileName": filename,
+            "link": drive_link,
+            "scopeKey": scope_key
+        }
+
+    # Make file public
+    drive_execute(service.permissions().create(
+        fileId=uploaded['id'],
+        body={'type': 'anyone', 'role': 'reader'}
+    ), 'permission')
+
+    print(f"✅ Uploaded: {filename} → {scope_key}/{subject}/{doctor}/{folder_path}")
+
+    # Send FCM if notify enabled
+    if notify:
+        enqueue_notification(
+            f"📂 New file — {subject}",
+            filename,
+            scope_key,
+            new_files=True,
+            idempotency_key=event_key('upload', scope_key, file_id)
+        )
+
+    return {
+        "success": True,
+        "fileId": file_id,
+        "fileName": filename,
+        "link": drive_link,
+        "scopeKey": scope_key
+    }
+
+# --- Helper: background upload jobs ---
+# With async=true the request only spools the file to UPLOAD_SPOOL_DIR and
+# returns 202 with a job ID; a bounded pool does the Drive work and
+# /upload-status/<id> reports progress and the final fileId/link. Job
+# status is written next to the spooled file, so any worker can answer.
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "unibot-uploads"))
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_LIMIT = 20
+UPLOAD_JOB_TTL = 3600
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+upload_jobs = {}
+upload_jobs_lock = threading.Lock()
+
+def upload_job_path(job_id):
+    return os.path.join(UPLOAD_SPOOL_DIR, f"{job_id}.json")
+
+def update_upload_job(job_id, **fields):
+    with upload_jobs_lock:
+        job = upload_jobs.get(job_id)
+        if not job:
+            return
+        job.update(fields, updatedAt=int(time.time() * 1000))
+        try:
+            write_json_file(upload_job_path(job_id), job)
+        except Exception as e:
+            print(f"Upload Job save error [{job_id}]: {e}")
+
+def prune_upload_jobs():
+    cutoff = (time.time() - UPLOAD_JOB_TTL) * 1000
+    with upload_jobs_lock:
+        for job_id in [j for j, job in upload_jobs.items() if job['status'] in ('done', 'error') and job['updatedAt'] < cutoff]:
+            del upload_jobs[job_id]
+            try:
+                os.remove(upload_job_path(job_id))
+            except OSError:
+                pass
+
+def run_upload_job(job_id, spool_path, upload_args):
+    update_upload_job(job_id, status='uploading')
+
+    def on_progress(sent, total):
+        update_upload_job(job_id, bytesSent=sent, totalBytes=total,
+                          progress=round(sent / total, 3) if total else 1.0)
+
+    try:
+        with open(spool_path, 'rb') as stream:
+            result = process_upload(stream, on_progress=on_progress, **upload_args)
+        update_upload_job(job_id, status='done', progress=1.0, fileId=result['fileId'], link=result['link'],
+                          duplicate=result.get('duplicate', False))
+    except Exception as e:
+        print(f"Upload Job Error [{job_id}]: {e}")
+        update_upload_job(job_id, status='error', error=str(e))
+    finally:
+        try:
+            os.remove(spool_path)
+        except OSError:
+            pass
+
+def enqueue_upload(file, upload_args):
+    prune_upload_jobs()
+    with upload_jobs_lock:
+        pending = sum(1 for job in upload_jobs.values() if job['status'] in ('queued', 'uploading'))
+    if pending >= UPLOAD_QUEUE_LIMIT:
+        return None
+    job_id = uuid.uuid4().hex
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(UPLOAD_SPOOL_DIR, job_id)
+    file.save(spool_path)
+    now = int(time.time() * 1000)
+    with upload_jobs_lock:
+        upload_jobs[job_id] = {
+            "jobId": job_id,
+            "status": "queued",
+            "fileName": upload_args['filename'],
+            "scopeKey": upload_args['scope_key'],
+            "bytesSent": 0,
+            "totalBytes": os.path.getsize(spool_path),
+            "progress": 0.0,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+    update_upload_job(job_id)
+    upload_executor.submit(run_upload_job, job_id, spool_path, upload_args)
+    return job_id
+
 # --- Upload file to Google Drive ---
 @app_flask.route('/upload-file', methods=['POST'])
 def upload_file():
@@ -345,316 +2167,924 @@ def upload_file():
     doctor      = request.form.get('doctor', '')
     folder_path = request.form.get('folder_path', '')  # e.g. "Lectures/Week1"
     notify      = request.form.get('notify', 'true') == 'true'
+    background  = request.form.get('async', 'false') == 'true'
+    scope_key   = normalize_scope_key(request.form.get('scopeKey', DEFAULT_SCOPE_KEY))
+
+    upload_args = {
+        'filename': file.filename,
+        'mimetype': file.mimetype,
+        'scope_key': scope_key,
+        'subject': subject,
+        'doctor': doctor,
+        'folder_path': folder_path,
+        'notify': notify,
+    }
+    promote_scope(scope_key)
+    try:
+        if background:
+            job_id = enqueue_upload(file, upload_args)
+            if not job_id:
+                return jsonify({"error": "Upload queue is full, retry later"}), 503
+            return jsonify({"success": True, "jobId": job_id, "status": "queued"}), 202
+        return jsonify(process_upload(file.stream, **upload_args))
+    except Exception as e:
+        print(f"Upload Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# --- Upload many files into one folder ---
+BATCH_UPLOAD_WORKERS = 4
+batch_upload_executor = ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS, thread_name_prefix='batch-upload')
+
+@app_flask.route('/upload-files', methods=['POST'])
+def upload_files():
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({"error": "No files"}), 400
+    subject     = request.form.get('subject', '')
+    doctor      = request.form.get('doctor', '')
+    folder_path = request.form.get('folder_path', '')
+    notify      = request.form.get('notify', 'true') == 'true'
     scope_key   = normalize_scope_key(request.form.get('scopeKey', DEFAULT_SCOPE_KEY))
+    promote_scope(scope_key)
 
     try:
+        # Resolve the folder chain once for every file
         service = get_drive_service()
+        folder_parts = upload_folder_parts(scope_key, subject, doctor, folder_path)
+        folder_id = resolve_folder_path(service, folder_parts)
 
-        # Navigate/create folder structure:
-        # Root -> Scopes -> scopeKey -> Subject -> Doctor -> [subfolders]
-        current_folder_id = DRIVE_FOLDER_ID
-        current_folder_id = get_or_create_folder(service, "Scopes", current_folder_id)
-        current_folder_id = get_or_create_folder(service, scope_key, current_folder_id)
-
-        if subject:
-            current_folder_id = get_or_create_folder(service, subject, current_folder_id)
-        if doctor:
-            current_folder_id = get_or_create_folder(service, doctor, current_folder_id)
-
-        # Handle extra subfolders e.g. "Lectures/Week1"
-        if folder_path:
-            for part in folder_path.split('/'):
-                part = part.strip()
-                if part:
-                    current_folder_id = get_or_create_folder(service, part, current_folder_id)
-
-        # Upload file into the final folder
-        file_content = file.read()
-        file_stream  = io.BytesIO(file_content)
-        media = MediaIoBaseUpload(file_stream, mimetype=file.mimetype, resumable=True)
-        file_metadata = {
-            'name': file.filename,
-            'parents': [current_folder_id]
-        }
-        uploaded = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, name, webViewLink'
-        ).execute()
-
-        # Make file public
-        service.permissions().create(
-            fileId=uploaded['id'],
-            body={'type': 'anyone', 'role': 'reader'}
-        ).execute()
-
-        drive_link = uploaded.get('webViewLink', '')
-        file_id    = uploaded.get('id', '')
-
-        print(f"✅ Uploaded: {file.filename} → {scope_key}/{subject}/{doctor}/{folder_path}")
-
-        # Send FCM if notify enabled
-        if notify:
-            send_fcm_new_files(
-                f"📂 New file — {subject}",
-                file.filename,
-                scope_key=scope_key
-            )
+        def upload_one(file):
+            try:
+                uploaded, duplicate = upload_to_folder(get_drive_service(), file.stream, file.filename,
+                                                       file.mimetype, folder_parts, folder_id)
+                return {"fileName": file.filename, "success": True, "duplicate": duplicate,
+                        "fileId": uploaded.get('id', ''), "link": uploaded.get('webViewLink', '')}
+            except Exception as e:
+                print(f"Upload Error [{file.filename}]: {e}")
+                return {"fileName": file.filename, "success": False, "error": str(e)}
+
+        results = list(batch_upload_executor.map(upload_one, files))
+        # Duplicates already exist (and are public): no permission, no push
+        uploaded = [r for r in results if r['success'] and not r['duplicate']]
+
+        # Make files public in batched permission calls
+        if uploaded:
+            errors = make_files_public(service, [r['fileId'] for r in uploaded])
+            for r in uploaded:
+                if r['fileId'] in errors:
+                    r['permissionError'] = str(errors[r['fileId']])
+
+        print(f"✅ Uploaded {len(uploaded)}/{len(files)} files → {scope_key}/{subject}/{doctor}/{folder_path}")
+        # Duplicates and notify=false uploads too: the new-files watcher must not announce them
+        landed = [r['fileName'] for r in results if r['success']]
+        if landed:
+            note_uploaded_files(scope_key, landed)
+
+        # One summarised notification instead of one per file
+        if notify and uploaded:
+            names = [r['fileName'] for r in uploaded]
+            title, body = new_files_message(names, subject)
+            enqueue_notification(title, body, scope_key, new_files=True,
+                                 idempotency_key=event_key('upload', scope_key, *[r['fileId'] for r in uploaded]))
 
         return jsonify({
-            "success": True,
-            "fileId": file_id,
-            "fileName": file.filename,
-            "link": drive_link,
+            "success": all(r['success'] for r in results),
+            "uploaded": len(uploaded),
+            "duplicates": sum(1 for r in results if r['success'] and r['duplicate']),
+            "failed": sum(1 for r in results if not r['success']),
+            "results": results,
             "scopeKey": scope_key
         })
     except Exception as e:
         print(f"Upload Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app_flask.route('/upload-status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    if not all(c in '0123456789abcdef' for c in job_id):
+        return jsonify({"error": "Unknown job"}), 404
+    with upload_jobs_lock:
+        job = upload_jobs.get(job_id)
+        job = dict(job) if job else None
+    if not job:
+        job = read_json_file(upload_job_path(job_id))  # owned by another worker
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
 # ==========================================
-# 9. Background Schedulers
+# 12. Background Schedulers
 # ==========================================
+# A single sweep hands parsed scope snapshots to the watcher handlers,
+# which receive (scope_key, db). `keys` lists the top-level subtrees a
+# handler reads: only those are fetched, and the stream listener runs a
+# handler as soon as one of its keys changes. While the stream is live the
+# sweep runs handlers on their own interval from the mirror; otherwise
+# each scope is polled on an adaptive cadence (see "Adaptive cadence").
+SWEEP_TICK = 30
+watcher_handlers = []
+handlers_lock = threading.Lock()
 
-# --- Poll watcher ---
-def poll_watcher():
-    import requests
-    print("🗳️ Poll Watcher started")
-    last_poll_id_by_scope = {}
-    time.sleep(30)
-    while True:
+def register_watcher(name, interval, handler, keys=()):
+    watcher_handlers.append({
+        'name': name,
+        'interval': interval,
+        'handler': handler,
+        'keys': tuple(keys),
+        'next_run': 0,
+    })
+
+def run_handler(h, scope_key, db):
+    with handlers_lock:
+        started = time.perf_counter()
         try:
-            for scope_key in get_all_scope_keys():
-                db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                poll = db.get('activePoll')
-                if poll and not poll.get('ended', False):
-                    poll_id = str(poll.get('question', '')) + str(poll.get('endsAt', 0))
-                    ends_at_ms  = poll.get('endsAt', 0)
-                    remaining_s = max(0, int((ends_at_ms - time.time() * 1000) / 1000))
-                    if poll_id != last_poll_id_by_scope.get(scope_key) and remaining_s > 0:
-                        print(f"🗳️ New poll [{scope_key}]: {poll.get('question','')}")
-                        send_fcm_all(
-                            "🗳️ New Poll — Vote Now!",
-                            poll.get('question', 'A new poll is waiting for your vote'),
-                            scope_key=scope_key
-                        )
-                        last_poll_id_by_scope[scope_key] = poll_id
+            h['handler'](scope_key, db)
         except Exception as e:
-            print(f"Poll Watcher Error: {e}")
-        time.sleep(30)
+            watcher_handler_errors_total.inc(handler=h['handler'].__name__)
+            print(f"{h['name']} Watcher Error [{scope_key}]: {e}")
+        finally:
+            watcher_handler_seconds.observe(time.perf_counter() - started, handler=h['handler'].__name__)
+
+# --- Poll watcher ---
+last_poll_id_by_scope = {}
+
+def poll_watcher(scope_key, db):
+    poll = db.get('activePoll')
+    if poll and not poll.get('ended', False):
+        poll_id = str(poll.get('question', '')) + str(poll.get('endsAt', 0))
+        ends_at_ms  = poll.get('endsAt', 0)
+        remaining_s = max(0, int((ends_at_ms - time.time() * 1000) / 1000))
+        if poll_id != last_poll_id_by_scope.get(scope_key) and remaining_s > 0:
+            print(f"🗳️ New poll [{scope_key}]: {poll.get('question','')}")
+            enqueue_notification(
+                "🗳️ New Poll — Vote Now!",
+                poll.get('question', 'A new poll is waiting for your vote'),
+                scope_key,
+                idempotency_key=event_key('poll', scope_key, poll_id)
+            )
+            last_poll_id_by_scope[scope_key] = poll_id
 
 # --- Quick Links watcher ---
-def quicklinks_watcher():
-    import requests
-    print("🔗 Quick Links Watcher started")
-    last_count_by_scope = {}
-    time.sleep(30)
+last_links_count_by_scope = {}
+
+def quicklinks_watcher(scope_key, db):
+    links = db.get('quickLinks', [])
+    if not isinstance(links, list):
+        links = []
+    count = len(links)
+    prev = last_links_count_by_scope.get(scope_key, -1)
+    if prev != -1 and count > prev:
+        new_link = links[-1]
+        print(f"🔗 New link [{scope_key}]: {new_link.get('title','')}")
+        enqueue_notification(
+            "🔗 New Link Added",
+            new_link.get('title', 'A new link is now available'),
+            scope_key,
+            idempotency_key=event_key('link', scope_key, count, new_link.get('title', ''), new_link.get('url', ''))
+        )
+    last_links_count_by_scope[scope_key] = count
+
+# --- New Files watcher ---
+# Per scope: subject -> (doctor `root` lists, {file key: (ts, name)}).
+# A subject whose `root` lists are the very objects seen last time is
+# skipped without being read; only the others are walked (iteratively,
+# so folder depth is unbounded), and every file not seen before with a
+# `ts` above the scope's high-water mark is reported in one notification.
+# Nothing is serialised: a string-stored `data` node decodes to new
+# objects on every change, and then the walk itself is the comparison.
+# Files that came in through /upload-file(s) are skipped, announced or
+# not (notify=false, duplicates); uploads may be served by any worker, so
+# those names are shared through a file.
+RECENT_UPLOAD_TTL = 600
+RECENT_UPLOADS_PATH = os.environ.get("RECENT_UPLOADS_PATH", os.path.join(tempfile.gettempdir(), "unibot-recent-uploads.json"))
+new_file_index = {}
+restored_file_high_water = {}  # scope -> ms, from the warm-start snapshot
+
+def note_uploaded_files(scope_key, names):
+    now = time.time()
+    try:
+        with file_lock(f"{RECENT_UPLOADS_PATH}.lock"):
+            recent_by_scope = read_json_file(RECENT_UPLOADS_PATH, {})
+            for recent in recent_by_scope.values():
+                for name in [n for n, ts in recent.items() if now - ts > RECENT_UPLOAD_TTL]:
+                    del recent[name]
+            recent = recent_by_scope.setdefault(normalize_scope_key(scope_key), {})
+            for name in names:
+                recent[name] = now
+            write_json_file(RECENT_UPLOADS_PATH, {s: r for s, r in recent_by_scope.items() if r})
+    except Exception as e:
+        print(f"Recent uploads save error: {e}")
+
+def recently_uploaded(scope_key, name):
+    ts = (read_json_file(RECENT_UPLOADS_PATH, {}).get(scope_key) or {}).get(name)
+    return ts is not None and time.time() - ts <= RECENT_UPLOAD_TTL
+
+def new_files_message(names, subject):
+    if len(names) == 1:
+        return f"📂 New file — {subject}", names[0]
+    title = f"📂 {len(names)} new files — {subject}" if subject else f"📂 {len(names)} new files"
+    return title, ", ".join(names[:3]) + ("…" if len(names) > 3 else "")
+
+def subject_roots(subject_val):
+    return tuple(val['root'] for key, val in subject_val.items()
+                 if key != 'doctors' and isinstance(val, dict) and 'root' in val)
+
+def index_subject_files(subject_key, subject_val):
+    files = {}
+    stack = []
+    for key, val in subject_val.items():
+        if key == 'doctors':
+            continue
+        if isinstance(val, dict) and 'root' in val:
+            stack.append((val['root'], f"{subject_key}/{key}"))
+    while stack:
+        items, path = stack.pop()
+        if not isinstance(items, list):
+            continue
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            item_path = f"{path}/{item.get('name', '')}"
+            if item.get('type') == 'file':
+                files[item.get('id') or item_path] = (item.get('ts', 0), item.get('name', ''))
+            elif item.get('type') == 'folder':
+                stack.append((item.get('children', []), item_path))
+    return files
+
+def new_files_watcher(scope_key, db):
+    database = db.get('database', {})
+    if not isinstance(database, dict):
+        return
+    state = new_file_index.get(scope_key)
+    if state and state['database'] is database:
+        return  # same snapshot as last time
+    first = state is None
+    if first:
+        restored = restored_file_high_water.pop(scope_key, None)
+        state = {'subjects': {}, 'high_water': restored or int(time.time() * 1000), 'database': None}
+        new_file_index[scope_key] = state
+        # With a mark from before the restart, files added since are announced
+        first = restored is None
+
+    added = []
+    for subject_key, subject_val in database.items():
+        if not isinstance(subject_val, dict):
+            continue
+        roots = subject_roots(subject_val)
+        prev = state['subjects'].get(subject_key)
+        if prev and len(prev[0]) == len(roots) and all(a is b for a, b in zip(prev[0], roots)):
+            continue  # same objects as last time: nothing in it changed
+        files = index_subject_files(subject_key, subject_val)
+        old_files = prev[1] if prev else {}
+        for key, (ts, name) in files.items():
+            if key not in old_files and ts > state['high_water']:
+                added.append((ts, name, subject_key))
+        state['subjects'][subject_key] = (roots, files)
+    for subject_key in [k for k in state['subjects'] if k not in database]:
+        del state['subjects'][subject_key]
+    state['database'] = database
+
+    if first:
+        newest = [ts for _, files in state['subjects'].values() for ts, _ in files.values()]
+        state['high_water'] = max([state['high_water']] + newest)
+        return
+    if not added:
+        return
+    added.sort()
+    state['high_water'] = max(state['high_water'], added[-1][0])
+    added = [a for a in added if not recently_uploaded(scope_key, a[1])]
+    if not added:
+        return
+    names = [name for _, name, _ in added]
+    subjects = {subject for _, _, subject in added}
+    title, body = new_files_message(names, subjects.pop() if len(subjects) == 1 else '')
+    print(f"🆕 {len(names)} new file(s) [{scope_key}]: {', '.join(names[:5])}")
+    enqueue_notification(title, body, scope_key, new_files=True,
+                         idempotency_key=event_key('files', scope_key, added[-1][0], *names))
+
+# --- Schedules watcher ---
+# The next fire time of every active schedule sits in a min-heap; the
+# engine thread sleeps until the earliest one is due, fires it and pushes
+# the following week's occurrence (O(log n) per fire), recomputed from the
+# local wall clock so a DST change does not shift it. A scope's entries
+# are rebuilt only when its `schedules` subtree changes; the rebuild
+# filters the scope's old entries out and re-heapifies, so the heap stays
+# one entry per active schedule. Fire times are persisted per schedule
+# under scopes/<key>/scheduleTriggers/<id>, a small targeted PATCH
+# instead of rewriting the whole `data` document.
+SCHEDULE_GRACE_MS = 2 * 60 * 1000  # still fire occurrences missed by this much
+schedule_heap = []  # (fire_at_ms, seq, scope_key, sched_key, version)
+schedule_cond = threading.Condition()
+schedules_by_scope = {}  # scope -> {'version', 'fingerprint', 'schedules': {sched_key: sched}}
+schedule_last_fired = {}  # (scope, sched_key) -> ms
+schedule_seq = [0]
+
+def schedule_key(sched):
+    ident = sched.get('id') or '|'.join(str(sched.get(k, '')) for k in ('day', 'time', 'subject', 'doctor', 'message'))
+    return hashlib.md5(str(ident).encode('utf-8')).hexdigest()[:16]
+
+def valid_schedule_day(day):
+    return not isinstance(day, bool) and day in range(7)
+
+def next_occurrence_ms(sched, after_ms):
+    """First occurrence of a weekly schedule at or after `after_ms`"""
+    sched_h, sched_m = map(int, str(sched.get('time', '')).split(':'))
+    after = datetime.fromtimestamp(after_ms / 1000)
+    day = sched.get('day')
+    if not valid_schedule_day(day):
+        raise ValueError(f"invalid schedule day: {day!r}")
+    days_ahead = (day - (after.weekday() + 1) % 7) % 7  # 0=Sunday like JavaScript
+    occ = after.replace(hour=sched_h, minute=sched_m, second=0, microsecond=0) + timedelta(days=days_ahead)
+    if occ < after:
+        occ += timedelta(days=7)
+    return int(occ.timestamp() * 1000)
+
+def push_schedule(fire_at, scope_key, key, version):
+    schedule_seq[0] += 1
+    heapq.heappush(schedule_heap, (fire_at, schedule_seq[0], scope_key, key, version))
+
+def sync_scope_schedules(scope_key, schedules):
+    if not isinstance(schedules, list):
+        schedules = []
+    fingerprint = hashlib.md5(json.dumps(schedules, sort_keys=True).encode('utf-8')).hexdigest()
+    state = schedules_by_scope.get(scope_key)
+    if state and state['fingerprint'] == fingerprint:
+        return
+    triggers = get_schedule_triggers(scope_key)
+    now_ms = int(time.time() * 1000)
+    with schedule_cond:
+        version = state['version'] + 1 if state else 1
+        if state:
+            # drop the superseded entries now instead of when they come due
+            schedule_heap[:] = [entry for entry in schedule_heap if entry[2] != scope_key]
+            heapq.heapify(schedule_heap)
+        by_key = {}
+        for sched in schedules:
+            if not isinstance(sched, dict) or not sched.get('active', False):
+                continue
+            if not valid_schedule_day(sched.get('day')):
+                continue  # anything outside 0-6 would wrap onto a real weekday
+            key = schedule_key(sched)
+            last = max(sched.get('lastTriggered', 0) or 0, triggers.get(key, 0) or 0,
+                       schedule_last_fired.get((scope_key, key), 0))
+            try:
+                fire_at = next_occurrence_ms(sched, now_ms - SCHEDULE_GRACE_MS)
+            except (ValueError, TypeError):
+                continue
+            if last >= fire_at:
+                fire_at = next_occurrence_ms(sched, fire_at + 60 * 1000)
+            by_key[key] = sched
+            push_schedule(fire_at, scope_key, key, version)
+        schedules_by_scope[scope_key] = {'version': version, 'fingerprint': fingerprint, 'schedules': by_key}
+        schedule_cond.notify()
+    print(f"⏰ Schedules loaded [{scope_key}]: {len(by_key)} active")
+
+def schedules_watcher(scope_key, db):
+    sync_scope_schedules(scope_key, db.get('schedules', []))
+
+def persist_schedule_triggers(scope_key, fired):
+    try:
+        rtdb_request(
+            'PATCH',
+            f"{scoped_db_base(scope_key)}/.json",
+            op='schedule_triggers',
+            scope=scope_key,
+            json={f"scheduleTriggers/{key}": ts for key, ts in fired.items()}
+        )
+        print(f"⏰ Schedule triggers saved [{scope_key}]: {len(fired)}")
+    except Exception as e:
+        print(f"⏰ Schedule save error [{scope_key}]: {e}")
+
+def schedule_engine():
+    print("⏰ Schedule Engine started")
     while True:
+        due = []
+        with schedule_cond:
+            now_ms = int(time.time() * 1000)
+            while schedule_heap and schedule_heap[0][0] <= now_ms:
+                fire_at, _, scope_key, key, version = heapq.heappop(schedule_heap)
+                state = schedules_by_scope.get(scope_key)
+                if not state or state['version'] != version or key not in state['schedules']:
+                    continue  # superseded by a rebuild
+                sched = state['schedules'][key]
+                due.append((fire_at, scope_key, key, sched))
+                push_schedule(next_occurrence_ms(sched, fire_at + 60 * 1000), scope_key, key, version)
+            if not due:
+                timeout = (schedule_heap[0][0] - now_ms) / 1000 if schedule_heap else 60
+                schedule_cond.wait(min(max(timeout, 0.05), 60))
+                continue
+        fired_by_scope = {}
+        for fire_at, scope_key, key, sched in due:
+            schedule_fire_lag_seconds.observe(max(0, time.time() * 1000 - fire_at) / 1000)
+            subject = sched.get('subject', '')
+            doctor  = sched.get('doctor', '')
+            message = sched.get('message', '')
+            print(f"⏰ Firing schedule [{scope_key}]: {subject} - {doctor}: {message}")
+            try:
+                enqueue_notification(
+                    f"🔔 Reminder — {doctor} ({subject})",
+                    message,
+                    scope_key,
+                    idempotency_key=event_key('schedule', scope_key, key, fire_at)
+                )
+            except Exception as e:
+                print(f"Schedule Engine Error [{scope_key}]: {e}")
+            fired_at = int(time.time() * 1000)
+            schedule_last_fired[(scope_key, key)] = fired_at
+            fired_by_scope.setdefault(scope_key, {})[key] = fired_at
+        for scope_key, fired in fired_by_scope.items():
+            persist_schedule_triggers(scope_key, fired)
+
+# --- Doctor notifications watcher ---
+last_notif_ts_by_scope = {}
+
+def notifications_watcher(scope_key, db):
+    updates = db.get('recentUpdates', [])
+    if updates and isinstance(updates, list):
+        newest = updates[0]
+        ts = newest.get('timestamp', 0)
+        last_ts = last_notif_ts_by_scope.setdefault(scope_key, int(time.time() * 1000))
+        if ts > last_ts:
+            last_notif_ts_by_scope[scope_key] = ts
+            enqueue_notification(
+                f"📢 {newest.get('doctor','')} — {newest.get('subject','')}",
+                newest.get('message', 'اشعار جديد'),
+                scope_key,
+                idempotency_key=event_key('update', scope_key, ts)
+            )
+
+# --- Broadcast watcher ---
+last_broadcast_ts_by_scope = {}
+
+def broadcast_watcher(scope_key, db):
+    broadcast = db.get('generalBroadcast', {})
+    last_ts = last_broadcast_ts_by_scope.get(scope_key, 0)
+    if broadcast.get('active') and broadcast.get('timestamp', 0) > last_ts:
+        last_broadcast_ts_by_scope[scope_key] = broadcast['timestamp']
+        enqueue_notification(
+            f"📣 {broadcast.get('title', 'اعلان جديد')}",
+            broadcast.get('body', ''),
+            scope_key,
+            idempotency_key=event_key('broadcast', scope_key, broadcast['timestamp'])
+        )
+
+# --- Adaptive cadence ---
+# Polled scopes that changed (or saw an /upload-file or /send-notification)
+# are re-polled every POLL_MIN_INTERVAL seconds; each unchanged poll
+# doubles the interval up to POLL_MAX_INTERVAL. Intervals are jittered so
+# scopes drift apart instead of firing in the same second. Any worker can
+# promote a scope by touching a file in PROMOTE_DIR, which the leader
+# checks every tick. After a (re)start the first polls are spread evenly
+# over POLL_STAGGER seconds instead of all landing in the first sweep.
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 300
+POLL_JITTER = 0.2
+POLL_STAGGER = 30
+SCOPE_LIST_INTERVAL = 60
+PROMOTE_DIR = os.environ.get("PROMOTE_DIR", os.path.join(tempfile.gettempdir(), "unibot-hot"))
+scope_cadence = {}  # scope -> {'interval', 'next_poll', 'db'}
+cadence_lock = threading.Lock()
+sweep_wake = threading.Event()
+scope_list = {'keys': [], 'fetched_at': 0}
+promote_seen = {}
+
+def jittered(interval):
+    return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+def mark_scope_hot(scope_key):
+    with cadence_lock:
+        state = scope_cadence.setdefault(scope_key, {'interval': POLL_MIN_INTERVAL, 'next_poll': 0, 'db': None})
+        state['interval'] = POLL_MIN_INTERVAL
+        state['next_poll'] = min(state['next_poll'], time.time() + jittered(POLL_MIN_INTERVAL))
+    sweep_wake.set()
+
+def promote_scope(scope_key):
+    """Poll a scope at the hot cadence; callable from any worker process"""
+    scope = normalize_scope_key(scope_key)
+    if leader_state['leader']:
+        mark_scope_hot(scope)
+        return
+    try:
+        os.makedirs(PROMOTE_DIR, exist_ok=True)
+        with open(os.path.join(PROMOTE_DIR, quote(scope, safe='')), 'w'):
+            pass
+    except OSError as e:
+        print(f"Promote error [{scope}]: {e}")
+
+def collect_promotions():
+    try:
+        entries = list(os.scandir(PROMOTE_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
         try:
-            for scope_key in get_all_scope_keys():
-                db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                links = db.get('quickLinks', [])
-                if not isinstance(links, list):
-                    links = []
-                count = len(links)
-                prev = last_count_by_scope.get(scope_key, -1)
-                if prev == -1:
-                    last_count_by_scope[scope_key] = count
-                elif count > prev:
-                    new_link = links[-1]
-                    print(f"🔗 New link [{scope_key}]: {new_link.get('title','')}")
-                    send_fcm_all(
-                        "🔗 New Link Added",
-                        new_link.get('title', 'A new link is now available'),
-                        scope_key=scope_key
-                    )
-                    last_count_by_scope[scope_key] = count
-                else:
-                    last_count_by_scope[scope_key] = count
-        except Exception as e:
-            print(f"Quick Links Watcher Error: {e}")
-        time.sleep(30)
+            mtime = entry.stat().st_mtime
+        except OSError:
+            continue
+        if mtime > promote_seen.get(entry.name, 0):
+            promote_seen[entry.name] = mtime
+            mark_scope_hot(unquote(entry.name))
 
-# --- New Files watcher ---
-def new_files_watcher():
-    import time
-    print("📂 New Files Watcher started")
-    last_seen_ts = int(time.time() * 1000)
-    time.sleep(60)
+def record_poll(scope_key, db):
+    """Update a scope's interval after a poll; returns True if it changed"""
+    now = time.time()
+    with cadence_lock:
+        state = scope_cadence.setdefault(scope_key, {'interval': POLL_MIN_INTERVAL, 'next_poll': 0, 'db': None})
+        if db is None:
+            db = state['db']  # not loaded: back off like an unchanged poll
+        changed = state['db'] is not None and state['db'] != db
+        if changed:
+            state['interval'] = POLL_MIN_INTERVAL
+        elif state['db'] is not None:
+            state['interval'] = min(state['interval'] * 2, POLL_MAX_INTERVAL)
+        state['db'] = db
+        state['next_poll'] = now + jittered(state['interval'])
+    return changed
+
+def known_scope_keys():
+    if time.time() - scope_list['fetched_at'] >= SCOPE_LIST_INTERVAL:
+        scope_list['keys'] = get_all_scope_keys()
+        scope_list['fetched_at'] = time.time()
+    return scope_list['keys']
+
+def poll_due_scopes():
+    """Fetch the scopes whose cadence is due and run every handler on them"""
+    collect_promotions()
+    scope_keys = known_scope_keys()  # may hit the network: not under cadence_lock
+    now = time.time()
+    with cadence_lock:
+        due = [s for s in scope_keys if scope_cadence.get(s, {}).get('next_poll', 0) <= now]
+        for s in due:
+            if s in scope_cadence:
+                watcher_lag_seconds.observe(now - scope_cadence[s]['next_poll'], mode='poll')
+    if not due:
+        return
+    keys = sorted({k for h in watcher_handlers for k in h['keys']})
+    refresh_scope_paths([(s, p) for s in due for p in subtree_paths(s, keys)])
+    for scope_key in due:
+        # Never block the sweep on a scope that missed the fetch deadline
+        db = get_scope_subtrees(scope_key, keys, cached_only=True)
+        if db is None:
+            record_poll(scope_key, None)
+            continue
+        if record_poll(scope_key, db):
+            print(f"🔥 Scope changed, polling every {POLL_MIN_INTERVAL}s [{scope_key}]")
+        for h in watcher_handlers:
+            run_handler(h, scope_key, db)
+
+def stagger_first_polls():
+    keys = list(known_scope_keys())
+    random.shuffle(keys)
+    now = time.time()
+    with cadence_lock:
+        for i, scope_key in enumerate(keys):
+            state = scope_cadence.setdefault(scope_key, {'interval': POLL_MIN_INTERVAL, 'next_poll': 0, 'db': None})
+            if not state['next_poll']:  # not already promoted
+                state['next_poll'] = now + POLL_STAGGER * i / len(keys)
+    print(f"🧹 First polls of {len(keys)} scopes spread over {POLL_STAGGER}s")
+
+def next_poll_at():
+    with cadence_lock:
+        return min((s['next_poll'] for s in scope_cadence.values()), default=time.time() + SWEEP_TICK)
+
+# --- Shared sweep ---
+def sweep_stream_mirror():
+    """Run the handlers that are due over the live stream mirror"""
+    now = time.time()
+    due = [h for h in watcher_handlers if now >= h['next_run']]
+    if not due:
+        return
+    for h in due:
+        if h['next_run']:
+            watcher_lag_seconds.observe(now - h['next_run'], mode='stream')
+    with stream_lock:
+        snapshots = list(stream_snapshot_by_scope.items())
+    for scope_key, db in snapshots:
+        for h in due:
+            run_handler(h, scope_key, db)
+    for h in due:
+        h['next_run'] = now + h['interval']
+
+def sweep_watcher():
+    print("🧹 Sweep Watcher started")
+    if WATCHER_MODE == 'stream':
+        time.sleep(SWEEP_TICK)  # give the stream a chance to connect first
+    try:
+        stagger_first_polls()
+    except Exception as e:
+        print(f"Sweep stagger error: {e}")
     while True:
         try:
-            db = get_database_sync(force_refresh=True)
-            database = db.get('database', {})
-            newest_ts      = 0
-            newest_name    = ""
-            newest_subject = ""
-
-            def scan(items, subject_key):
-                nonlocal newest_ts, newest_name, newest_subject
-                if not isinstance(items, list):
-                    return
-                for item in items:
-                    if item.get('type') == 'file' and item.get('ts', 0) > newest_ts:
-                        newest_ts      = item['ts']
-                        newest_name    = item.get('name', '')
-                        newest_subject = subject_key
-                    if item.get('type') == 'folder':
-                        scan(item.get('children', []), subject_key)
-
-            for subject_key, subject_val in database.items():
-                if not isinstance(subject_val, dict):
-                    continue
-                for key, val in subject_val.items():
-                    if key == 'doctors':
-                        continue
-                    if isinstance(val, dict) and 'root' in val:
-                        scan(val['root'], subject_key)
-
-            if newest_ts > last_seen_ts:
-                print(f"🆕 New file: {newest_name} ({newest_subject})")
-                send_fcm_new_files(
-                    f"📂 New file — {newest_subject}",
-                    newest_name
-                )
-                last_seen_ts = newest_ts
+            if stream_state['connected']:
+                with sweep_seconds.time(mode='stream'):
+                    sweep_stream_mirror()
+                wake_at = min(h['next_run'] for h in watcher_handlers)
             else:
-                print(f"📂 No new files (last_ts={last_seen_ts})")
+                with sweep_seconds.time(mode='poll'):
+                    poll_due_scopes()
+                wake_at = next_poll_at()
         except Exception as e:
-            print(f"New Files Watcher Error: {e}")
-        time.sleep(60)
+            print(f"Sweep Watcher Error: {e}")
+            wake_at = time.time() + SWEEP_TICK
+        # Wake at least every second to pick up promotions from other workers
+        sweep_wake.wait(min(max(wake_at - time.time(), 0.05), 1))
+        sweep_wake.clear()
 
-# --- Schedules watcher ---
-def schedules_watcher():
-    import requests as req
-    print("⏰ Schedules Watcher started")
-    time.sleep(30)
+register_watcher("🗳️ Poll",          30, poll_watcher,          keys=('activePoll',))
+register_watcher("🔗 Quick Links",   30, quicklinks_watcher,    keys=('quickLinks',))
+register_watcher("⏰ Schedules",     60, schedules_watcher,     keys=('schedules',))
+register_watcher("📢 Notifications", 30, notifications_watcher, keys=('recentUpdates',))
+register_watcher("📣 Broadcast",     30, broadcast_watcher,     keys=('generalBroadcast',))
+register_watcher("📂 New Files",     60, new_files_watcher,     keys=('database',))
+if FCM_DELIVERY_MODE == 'topic':
+    register_watcher("📡 Topics",    30, topic_sync_watcher)
+
+# ==========================================
+# 13. Streaming listener
+# ==========================================
+# Opens a text/event-stream on /scopes, applies put/patch events to an
+# in-memory mirror of the raw scope documents and runs the handlers whose
+# subtrees changed. While the stream is connected the sweep reads the
+# mirror instead of Firebase; when it drops, the sweep polls as before.
+STREAM_RECONNECT_DELAY = 5
+STREAM_READ_TIMEOUT = 90  # RTDB sends keep-alive every ~30s
+stream_state = {'connected': False}
+stream_lock = threading.Lock()
+scopes_mirror = {}
+stream_snapshot_by_scope = {}
+
+def set_mirror_path(root, parts, value):
+    if not parts:
+        return value if value is not None else {}
+    node = root
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            if value is None:
+                return root
+            child = {}
+            node[part] = child
+        node = child
+    if value is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = value
+    return root
+
+def apply_stream_event(event, path, data):
+    """Apply one put/patch event to the mirror and return changed scope keys"""
+    global scopes_mirror
+    parts = [p for p in path.split('/') if p]
+    if event == 'put':
+        if not parts:
+            changed = set(scopes_mirror) | set(data or {})
+            scopes_mirror = data if isinstance(data, dict) else {}
+            return changed
+        scopes_mirror = set_mirror_path(scopes_mirror, parts, data)
+        return {parts[0]}
+    if event == 'patch' and isinstance(data, dict):
+        changed = set()
+        for key, value in data.items():
+            sub = parts + [p for p in key.split('/') if p]
+            scopes_mirror = set_mirror_path(scopes_mirror, sub, value)
+            if sub:
+                changed.add(sub[0])
+        return changed
+    return set()
+
+def detach(node):
+    # Copy a mirror subtree, which later events mutate in place
+    return json_loads(json.dumps(node)) if isinstance(node, (dict, list)) else node
+
+def dispatch_stream_changes(changed_scopes):
+    for scope_key in changed_scopes:
+        raw = scopes_mirror.get(scope_key)
+        with stream_lock:
+            prev = stream_snapshot_by_scope.get(scope_key)
+            if raw is None:
+                stream_snapshot_by_scope.pop(scope_key, None)
+                continue
+            if not isinstance(raw, dict):
+                raw = {}
+            # A string `data` node is immutable and decoded through the
+            # parse cache; only JSON-tree nodes need copying
+            data = detach(raw.get('data'))
+            db = parse_scope_doc({'data': data})
+            stream_snapshot_by_scope[scope_key] = db
+            user_tokens = detach(raw.get('userTokens')) or {}
+            schedule_triggers = detach(raw.get('scheduleTriggers'))
+        scope_shapes[scope_key] = 'tree' if isinstance(data, dict) and 'data' not in data else 'string'
+        prev_tokens = scope_cache.peek_entry((scope_key, 'userTokens'))
+        scope_cache.put((scope_key, 'data'), {
+            'value': db,
+            'size': len(data) if isinstance(data, str) else len(json.dumps(data)),
+        })
+        scope_cache.put((scope_key, 'userTokens'), {'value': user_tokens, 'size': len(json.dumps(user_tokens))})
+        scope_cache.put((scope_key, 'scheduleTriggers'), {'value': schedule_triggers})
+        update_token_registry(scope_key, user_tokens)
+        if FCM_DELIVERY_MODE == 'topic' and (not prev_tokens or prev_tokens['value'] != user_tokens):
+            try:
+                sync_scope_topics(scope_key, user_tokens)
+            except Exception as e:
+                print(f"📡 Topic sync error [{scope_key}]: {e}")
+        for h in watcher_handlers:
+            if prev is None or any(db.get(k) != prev.get(k) for k in h['keys']):
+                run_handler(h, scope_key, db)
+
+def read_event_stream(resp):
+    """Yield (event, data) pairs from a text/event-stream response"""
+    event, data_lines = None, []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if event:
+                yield event, '\n'.join(data_lines)
+            event, data_lines = None, []
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            data_lines.append(line[5:].lstrip())
+
+def listen_scopes_stream():
+    # Dedicated connection: the stream would otherwise pin a pooled one
+    resp = requests.get(
+        f"{FIREBASE_DB_URL}/scopes.json",
+        headers={'Accept': 'text/event-stream'},
+        stream=True,
+        timeout=(10, STREAM_READ_TIMEOUT)
+    )
+    try:
+        if resp.status_code != 200:
+            print(f"📡 Stream status: {resp.status_code}")
+            return
+        print("📡 Stream connected")
+        resp.encoding = 'utf-8'
+        for event, data in read_event_stream(resp):
+            if event in ('put', 'patch'):
+                payload = json.loads(data) if data else {}
+                changed = apply_stream_event(event, payload.get('path', '/'), payload.get('data'))
+                dispatch_stream_changes(changed)
+                stream_state['connected'] = True
+            elif event in ('cancel', 'auth_revoked'):
+                print(f"📡 Stream {event}: {data}")
+                return
+    finally:
+        stream_state['connected'] = False
+        resp.close()
+
+def stream_watcher():
+    print("📡 Stream Watcher started")
     while True:
         try:
-            for scope_key in get_all_scope_keys():
-                db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                schedules = db.get('schedules', [])
-                if not isinstance(schedules, list):
-                    schedules = []
-
-                now = datetime.now()
-                current_day = (now.weekday() + 1) % 7  # 0=Sunday like JavaScript
-                current_time = now.strftime('%H:%M')
-                changed = False
-
-                for sched in schedules:
-                    if not sched.get('active', False):
-                        continue
-                    sched_day  = sched.get('day', -1)
-                    sched_time = sched.get('time', '')
-                    last_triggered = sched.get('lastTriggered', 0)
-
-                    if sched_day != current_day:
-                        continue
-                    try:
-                        sched_h, sched_m = map(int, sched_time.split(':'))
-                        sched_total = sched_h * 60 + sched_m
-                        now_total   = now.hour * 60 + now.minute
-                        if abs(now_total - sched_total) > 2:
-                            continue
-                    except:
-                        continue
-
-                    last_dt = datetime.fromtimestamp(last_triggered / 1000) if last_triggered else None
-                    if last_dt and last_dt.date() == now.date() and last_dt.strftime('%H:%M') == current_time:
-                        continue
-
-                    subject = sched.get('subject', '')
-                    doctor  = sched.get('doctor', '')
-                    message = sched.get('message', '')
-
-                    print(f"⏰ Firing schedule [{scope_key}]: {subject} - {doctor}: {message}")
-                    send_fcm_all(
-                        f"🔔 Reminder — {doctor} ({subject})",
-                        message,
-                        scope_key=scope_key
-                    )
-
-                    sched['lastTriggered'] = int(now.timestamp() * 1000)
-                    changed = True
-
-                if changed:
-                    try:
-                        full_db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                        full_db['schedules'] = schedules
-                        import json as _json
-                        req.patch(
-                            f"{scoped_db_base(scope_key)}/.json",
-                            json={'data': _json.dumps(full_db)},
-                            timeout=10
-                        )
-                        print(f"⏰ Schedules updated in Firebase [{scope_key}]")
-                    except Exception as e:
-                        print(f"⏰ Schedule save error [{scope_key}]: {e}")
-
+            listen_scopes_stream()
         except Exception as e:
-            print(f"Schedules Watcher Error: {e}")
-        time.sleep(60)  # Check every minute
+            print(f"📡 Stream Watcher Error: {e}")
+        stream_state['connected'] = False
+        time.sleep(STREAM_RECONNECT_DELAY)
 
-# --- Doctor notifications watcher ---
-def notifications_watcher():
-    print("📢 Notifications Watcher started")
-    last_notif_ts_by_scope = {}
-    time.sleep(30)
+# ==========================================
+# 14. Start
+# ==========================================
+# --- Warm-start snapshot ---
+# The watcher leader writes the scope cache, each scope's poll interval
+# and the watchers' high-water marks to SNAPSHOT_PATH every
+# SNAPSHOT_INTERVAL seconds and at exit, and loads it when it wins the
+# election (other workers never run the watchers and fill their caches on
+# demand). Entries the process already fetched itself are kept.
+# Restored entries keep their original fetch time, so they are served as
+# stale and revalidated by ETag (an unchanged body is not parsed again)
+# instead of being decoded afresh, and the watchers neither repeat nor miss what
+# changed while the process was down. userTokens entries (emails and FCM
+# tokens) are left out and the file is created owner-only.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "unibot-snapshot.json"))
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_MAX_AGE = 24 * 3600
+SNAPSHOT_CACHE_FIELDS = ('value', 'etag', 'fetched_at', 'size')
+
+def save_snapshot():
+    if not leader_state['leader']:
+        return
+    with scope_cache.lock:
+        cache = [[list(key), {f: entry[f] for f in SNAPSHOT_CACHE_FIELDS if f in entry}]
+                 for key, entry in scope_cache.entries.items() if key[1] != 'userTokens']
+    with cadence_lock:
+        cadence = {s: state['interval'] for s, state in scope_cadence.items()}
+    write_json_file(SNAPSHOT_PATH, {
+        'savedAt': time.time(),
+        'cache': cache,
+        'shapes': dict(scope_shapes),
+        'cadence': cadence,
+        'marks': {
+            'poll': dict(last_poll_id_by_scope),
+            'links': dict(last_links_count_by_scope),
+            'notifications': dict(last_notif_ts_by_scope),
+            'broadcast': dict(last_broadcast_ts_by_scope),
+            'files': {s: state['high_water'] for s, state in list(new_file_index.items())},
+        },
+    }, private=True)
+    print(f"💾 Snapshot saved: {len(cache)} cache entries, {len(cadence)} scopes")
+
+def load_snapshot():
+    snapshot = read_json_file(SNAPSHOT_PATH)
+    if not snapshot:
+        return
+    age = time.time() - snapshot.get('savedAt', 0)
+    if age > SNAPSHOT_MAX_AGE:
+        print(f"💾 Snapshot ignored: {int(age)}s old")
+        return
+    for key, entry in snapshot.get('cache', []):
+        key = tuple(key)
+        if key[1] != 'userTokens' and scope_cache.peek_entry(key) is None:  # older snapshots carry userTokens
+            scope_cache.put(key, entry)
+    scope_shapes.update(snapshot.get('shapes', {}))
+    with cadence_lock:
+        for scope_key, interval in snapshot.get('cadence', {}).items():
+            scope_cadence.setdefault(scope_key, {'interval': interval, 'next_poll': 0, 'db': None})
+    marks = snapshot.get('marks', {})
+    last_poll_id_by_scope.update(marks.get('poll', {}))
+    last_links_count_by_scope.update(marks.get('links', {}))
+    last_notif_ts_by_scope.update(marks.get('notifications', {}))
+    last_broadcast_ts_by_scope.update(marks.get('broadcast', {}))
+    restored_file_high_water.update(marks.get('files', {}))
+    print(f"💾 Snapshot loaded: {len(snapshot.get('cache', []))} cache entries from {int(age)}s ago")
+
+def snapshot_watcher():
     while True:
+        time.sleep(SNAPSHOT_INTERVAL)
         try:
-            for scope_key in get_all_scope_keys():
-                db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                updates = db.get('recentUpdates', [])
-                if updates and isinstance(updates, list):
-                    newest = updates[0]
-                    ts = newest.get('timestamp', 0)
-                    last_ts = last_notif_ts_by_scope.get(scope_key, int(time.time() * 1000))
-                    if ts > last_ts:
-                        last_notif_ts_by_scope[scope_key] = ts
-                        send_fcm_all(
-                            f"📢 {newest.get('doctor','')} — {newest.get('subject','')}",
-                            newest.get('message', 'اشعار جديد'),
-                            scope_key=scope_key
-                        )
-                        print(f"📢 Notification sent [{scope_key}]: {newest.get('message','')}")
+            save_snapshot()
         except Exception as e:
-            print(f"Notifications Watcher Error: {e}")
-        time.sleep(30)
+            print(f"💾 Snapshot save error: {e}")
 
-# --- Broadcast watcher ---
-def broadcast_watcher():
-    print("📣 Broadcast Watcher started")
-    last_broadcast_ts_by_scope = {}
-    time.sleep(30)
+def save_snapshot_at_exit():
+    try:
+        save_snapshot()
+    except Exception as e:
+        print(f"💾 Snapshot save error: {e}")
+
+atexit.register(save_snapshot_at_exit)
+# gunicorn workers exit cleanly on SIGTERM; a bare `python api.py` would
+# be killed without running atexit handlers
+try:
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+except ValueError:  # imported outside the main thread
+    pass
+
+# --- Watcher leader ---
+# Every gunicorn worker imports this module, but only the process holding
+# the flock on WATCHER_LOCK_PATH runs the watchers, so pushes are sent
+# once. The lock belongs to the open file: when the leader dies the kernel
+# releases it and a waiting worker takes over within LEADER_RETRY_INTERVAL.
+# Invalid-token cleanup runs in every process since each queues its own.
+LEADER_RETRY_INTERVAL = 5
+leader_state = {'leader': False, 'lock_file': None}
+
+def try_become_leader():
+    if fcntl is None:
+        return True
+    lock_file = open(WATCHER_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    leader_state['lock_file'] = lock_file  # kept open for the process lifetime
+    return True
+
+def start_leader_watchers():
+    start_outbox()
+    threading.Thread(target=snapshot_watcher, daemon=True).start()
+    threading.Thread(target=sweep_watcher, daemon=True).start()
+    threading.Thread(target=schedule_engine, daemon=True).start()
+    if WATCHER_MODE == 'stream':
+        threading.Thread(target=stream_watcher, daemon=True).start()
+    print(f"✅ All watchers started: {', '.join(h['name'] for h in watcher_handlers)}")
+
+def leader_election():
     while True:
         try:
-            for scope_key in get_all_scope_keys():
-                db = get_database_sync(force_refresh=True, scope_key=scope_key)
-                broadcast = db.get('generalBroadcast', {})
-                last_ts = last_broadcast_ts_by_scope.get(scope_key, 0)
-                if broadcast.get('active') and broadcast.get('timestamp', 0) > last_ts:
-                    last_broadcast_ts_by_scope[scope_key] = broadcast['timestamp']
-                    send_fcm_all(
-                        f"📣 {broadcast.get('title', 'اعلان جديد')}",
-                        broadcast.get('body', ''),
-                        scope_key=scope_key
-                    )
-                    print(f"📣 Broadcast sent [{scope_key}]: {broadcast.get('title','')}")
+            if try_become_leader():
+                break
         except Exception as e:
-            print(f"Broadcast Watcher Error: {e}")
-        time.sleep(30)
+            print(f"👑 Leader election error: {e}")
+        time.sleep(LEADER_RETRY_INTERVAL)
+    leader_state['leader'] = True
+    print(f"👑 Watcher leader: pid {os.getpid()}")
+    try:
+        load_snapshot()
+    except Exception as e:
+        print(f"💾 Snapshot load error: {e}")
+    start_leader_watchers()
 
-# ==========================================
-# 10. Start
-# ==========================================
 def start_watchers():
     print("🚀 Starting all watchers...")
-    threading.Thread(target=poll_watcher,            daemon=True).start()
-    threading.Thread(target=quicklinks_watcher,      daemon=True).start()
-    threading.Thread(target=schedules_watcher,       daemon=True).start()
-    threading.Thread(target=notifications_watcher,   daemon=True).start()
-    threading.Thread(target=broadcast_watcher,       daemon=True).start()
-    print("✅ All watchers started")
+    threading.Thread(target=token_cleanup_watcher, daemon=True).start()
+    if RUN_WATCHERS == 'never':
+        print("⏸️ Watchers disabled in this process (RUN_WATCHERS=never)")
+        return
+    threading.Thread(target=leader_election, daemon=True).start()
 
 # Auto-start watchers when gunicorn loads the module
 start_watchers()
@@ -0,0 +1,264 @@
+"""Local stand-in for the Google Drive v3 and OAuth token endpoints.
+
+Covers what api.py calls: the refresh-token grant, files().list (the
+`name`, `in parents`, `mimeType` and `trashed` terms of `q`, with
+paging), files().get, folder files().create, resumable media uploads
+(308 + Range until the last chunk) and permissions().create, directly
+or through a multipart/mixed batch. Uploaded bytes are hashed and
+dropped, so a 500 MB upload costs no memory here.
+
+    python bench/fake_drive.py --port 9100 --latency 0.05
+    DRIVE_API_ENDPOINT=http://127.0.0.1:9100 GOOGLE_TOKEN_URI=http://127.0.0.1:9100/token python api.py
+"""
+import argparse
+import email.parser
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+RESUMABLE_PREFIX = '/upload/drive/v3/files'
+
+
+def parse_query(q):
+    """The subset of the Drive query language api.py uses, ANDed together"""
+    terms = []
+    for match in re.finditer(r"name\s*=\s*'((?:[^'\\]|\\.)*)'", q or ''):
+        name = re.sub(r"\\(.)", r"\1", match.group(1))
+        terms.append(lambda f, name=name: f['name'] == name)
+    for match in re.finditer(r"'([^']+)'\s+in\s+parents", q or ''):
+        terms.append(lambda f, parent=match.group(1): parent in f['parents'])
+    for match in re.finditer(r"mimeType\s*(!?=)\s*'([^']+)'", q or ''):
+        op, mime = match.groups()
+        terms.append(lambda f, op=op, mime=mime: (f['mimeType'] == mime) == (op == '='))
+    if re.search(r"trashed\s*=\s*false", q or ''):
+        terms.append(lambda f: not f['trashed'])
+    return lambda f: all(term(f) for term in terms)
+
+
+class FakeDrive:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self.uploads = {}  # upload_id -> {'meta', 'total', 'received', 'md5'}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_received = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total': sum(self.requests.values()),
+                    'bytes_received': self.bytes_received, 'files': len(self.files)}
+
+    def _count(self, op, received=0):
+        with self.lock:
+            self.requests[op] += 1
+            self.bytes_received += received
+
+    def _new_file(self, meta, mime=None, md5=None, size=None):
+        file_id = uuid.uuid4().hex[:28]
+        f = {
+            'id': file_id,
+            'name': meta.get('name', 'Untitled'),
+            'mimeType': meta.get('mimeType') or mime or 'application/octet-stream',
+            'parents': meta.get('parents') or ['root'],
+            'trashed': False,
+            'webViewLink': f"https://drive.google.com/file/d/{file_id}/view",
+        }
+        if md5:
+            f['md5Checksum'] = md5
+            f['size'] = str(size)
+        with self.lock:
+            self.files[file_id] = f
+        return dict(f)
+
+    # --- request routing (plain HTTP and batch parts share it) ---
+    def handle(self, method, target, headers, body, upload_url=None):
+        """Returns (status, headers, json-or-None)"""
+        split = urlsplit(target)
+        path = split.path
+        query = {k: v[-1] for k, v in parse_qs(split.query).items()}
+
+        if path == '/token' and method == 'POST':
+            self._count('token')
+            return 200, {}, {'access_token': 'fake-' + uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'}
+
+        if path == RESUMABLE_PREFIX and method == 'POST' and query.get('uploadType') == 'resumable':
+            self._count('upload_start')
+            upload_id = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[upload_id] = {
+                    'meta': json.loads(body or b'{}'),
+                    'mime': headers.get('X-Upload-Content-Type'),
+                    'total': None, 'received': 0, 'md5': hashlib.md5(),
+                }
+            return 200, {'Location': f"{upload_url}{RESUMABLE_PREFIX}?uploadType=resumable&upload_id={upload_id}"}, None
+
+        if path == RESUMABLE_PREFIX and method == 'PUT':
+            return self._upload_chunk(query.get('upload_id'), headers, body)
+
+        if path == '/drive/v3/files' and method == 'GET':
+            self._count('list')
+            return 200, {}, self._list(query)
+
+        if path == '/drive/v3/files' and method == 'POST':
+            self._count('create')
+            return 200, {}, self._new_file(json.loads(body or b'{}'))
+
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)/permissions', path)
+        if match and method == 'POST':
+            self._count('permission')
+            if match.group(1) not in self.files:
+                return 404, {}, {'error': {'code': 404, 'message': 'File not found'}}
+            return 200, {}, {'kind': 'drive#permission', 'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'}
+
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)', path)
+        if match and method == 'GET':
+            self._count('get')
+            f = self.files.get(match.group(1))
+            if not f:
+                return 404, {}, {'error': {'code': 404, 'message': 'File not found'}}
+            return 200, {}, dict(f)
+
+        self._count('unknown')
+        return 404, {}, {'error': {'code': 404, 'message': f'No fake for {method} {path}'}}
+
+    def _list(self, query):
+        matches = parse_query(query.get('q'))
+        with self.lock:
+            found = [dict(f) for f in self.files.values() if matches(f)]
+        size = int(query.get('pageSize') or 100)
+        start = int(query.get('pageToken') or 0)
+        result = {'files': found[start:start + size]}
+        if start + size < len(found):
+            result['nextPageToken'] = str(start + size)
+        return result
+
+    def _upload_chunk(self, upload_id, headers, body):
+        self._count('upload_chunk', len(body))
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+        if not upload:
+            return 404, {}, {'error': {'code': 404, 'message': 'Upload session not found'}}
+        # "bytes 0-262143/1048576", "bytes 0-262143/*" or "bytes */1048576"
+        match = re.fullmatch(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', headers.get('Content-Range') or 'bytes */*')
+        if match and match.group(4) != '*':
+            upload['total'] = int(match.group(4))
+        if match and match.group(2) is not None:
+            if int(match.group(2)) != upload['received']:
+                return 400, {}, {'error': {'code': 400, 'message': 'Chunk out of order'}}
+            upload['md5'].update(body)
+            upload['received'] += len(body)
+        if upload['total'] is not None and upload['received'] >= upload['total']:
+            with self.lock:
+                self.uploads.pop(upload_id, None)
+            return 200, {}, self._new_file(upload['meta'], upload['mime'], upload['md5'].hexdigest(), upload['received'])
+        extra = {'Range': f"bytes=0-{upload['received'] - 1}"} if upload['received'] else {}
+        return 308, extra, None
+
+    def _batch(self, content_type, body):
+        self._count('batch')
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_' + uuid.uuid4().hex
+        out = []
+        for part in message.get_payload():
+            raw = part.get_payload(decode=True).replace(b'\r\n', b'\n')
+            head, _, part_body = raw.partition(b'\n\n')
+            lines = head.decode('utf-8').split('\n')
+            method, target, _ = lines[0].split(' ', 2)
+            part_headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            status, _, value = self.handle(method, target, part_headers, part_body)
+            payload = json.dumps(value) if value is not None else ''
+            content_id = re.sub(r'\r?\n', '', part['Content-ID']).strip('<>')  # unfold
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{payload}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        return boundary, ''.join(out).encode('utf-8')
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _respond(self, status, headers, value):
+                body = json.dumps(value).encode('utf-8') if value is not None else b''
+                self.send_response(status)
+                for key, val in headers.items():
+                    self.send_header(key, val)
+                if value is not None:
+                    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self, method):
+                body = self._read_body()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if urlsplit(self.path).path == '/batch/drive/v3':
+                    boundary, payload = fake._batch(self.headers.get('Content-Type', ''), body)
+                    self.send_response(200)
+                    self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                self._respond(*fake.handle(method, self.path, self.headers, body, upload_url=fake.url))
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+    fake = FakeDrive(host=args.host, port=args.port, latency=args.latency)
+    print(f"🧪 Fake Drive listening on {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""In-process stand-in for firebase_admin.messaging.
+
+install() swaps send_each, send and the topic (un)subscribe calls for
+fakes that sleep `latency` seconds per round-trip, reject batches over
+500 messages like the real API, and report tokens that start with
+`invalid_prefix` as unregistered. Nothing leaves the process.
+
+    from fake_fcm import FakeFCM
+    fcm = FakeFCM(latency=0.1).install()
+    ...
+    fcm.stats()  # {'requests': {'send_each': 20, ...}, 'messages': 10000, ...}
+"""
+import threading
+import time
+from collections import Counter
+
+from firebase_admin import messaging
+from firebase_admin import exceptions as firebase_exceptions
+
+MAX_BATCH = 500
+
+
+class FakeFCM:
+    def __init__(self, latency=0.0, invalid_prefix='invalid-'):
+        self.latency = latency
+        self.invalid_prefix = invalid_prefix
+        self.requests = Counter()
+        self.messages = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def install(self):
+        for name in ('send_each', 'send', 'subscribe_to_topic', 'unsubscribe_from_topic'):
+            self.originals[name] = getattr(messaging, name)
+            setattr(messaging, name, getattr(self, name))
+        return self
+
+    def uninstall(self):
+        for name, fn in self.originals.items():
+            setattr(messaging, name, fn)
+        self.originals = {}
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total': sum(self.requests.values()),
+                    'messages': self.messages, 'failures': self.failures}
+
+    def _count(self, op, messages=0, failures=0):
+        with self.lock:
+            self.requests[op] += 1
+            self.messages += messages
+            self.failures += failures
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _response(self, token):
+        if token and token.startswith(self.invalid_prefix):
+            return messaging.SendResponse(None, messaging.UnregisteredError('Requested entity was not found.'))
+        return messaging.SendResponse({'name': f'projects/fake/messages/{token}'}, None)
+
+    def send_each(self, messages, dry_run=False, app=None):
+        if len(messages) > MAX_BATCH:
+            raise ValueError(f'messages must not contain more than {MAX_BATCH} elements.')
+        responses = [self._response(m.token) for m in messages]
+        self._count('send_each', len(messages), sum(1 for r in responses if not r.success))
+        return messaging.BatchResponse(responses)
+
+    def send(self, message, dry_run=False, app=None):
+        self._count('send', 1)
+        if message.token and message.token.startswith(self.invalid_prefix):
+            raise messaging.UnregisteredError('Requested entity was not found.')
+        return f'projects/fake/messages/{message.topic or message.token}'
+
+    def subscribe_to_topic(self, tokens, topic, app=None):
+        return self._topic_response('subscribe_to_topic', tokens)
+
+    def unsubscribe_from_topic(self, tokens, topic, app=None):
+        return self._topic_response('unsubscribe_from_topic', tokens)
+
+    def _topic_response(self, op, tokens):
+        tokens = [tokens] if isinstance(tokens, str) else list(tokens)
+        if len(tokens) > 1000:
+            raise firebase_exceptions.InvalidArgumentError('Tokens list must not contain more than 1000 items')
+        results = [{'error': 'NOT_FOUND'} if t.startswith(self.invalid_prefix) else {} for t in tokens]
+        self._count(op, len(tokens), sum(1 for r in results if r))
+        return messaging.TopicManagementResponse({'results': results})
@@ -0,0 +1,250 @@
+"""Local stand-in for the Firebase Realtime Database REST API.
+
+Serves GET/PUT/PATCH/DELETE on `<path>.json` from an in-memory tree and
+streams `put`/`patch` server-sent events to clients that ask for
+`text/event-stream`, like RTDB does. GET honours `?shallow=true` and
+`X-Firebase-ETag: true`. RTDB only documents ETags for `if-match`
+writes, so a GET whose `If-None-Match` matches still gets the full 200
+(counted as "GET unchanged"); `not_modified=True` (`--not-modified`)
+answers 304 instead. Every request can be delayed by `latency` seconds
+and is counted per method.
+
+    python bench/fake_rtdb.py --port 9000 --seed seed.json --latency 0.05
+    FIREBASE_DB_URL=http://127.0.0.1:9000 python api.py
+"""
+import argparse
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+KEEP_ALIVE_INTERVAL = 30
+
+
+def split_path(path):
+    return [unquote(p) for p in path.split('/') if p]
+
+
+def get_node(root, parts):
+    node = root
+    for part in parts:
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def set_node(root, parts, value):
+    if not parts:
+        return value if value is not None else {}
+    if not isinstance(root, dict):
+        root = {}
+    node = root
+    for part in parts[:-1]:
+        if not isinstance(node.get(part), dict):
+            node[part] = {}
+        node = node[part]
+    if value is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = value
+    return root
+
+
+class FakeRTDB:
+    def __init__(self, seed=None, host='127.0.0.1', port=0, latency=0.0, not_modified=False):
+        self.tree = seed or {}
+        self.latency = latency
+        self.not_modified = not_modified
+        self.requests = Counter()  # "GET", "GET shallow", "GET unchanged", "GET 304", "STREAM", ...
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.listeners = []  # (parts, queue)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for _, q in list(self.listeners):
+            q.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total': sum(self.requests.values()),
+                    'bytes_sent': self.bytes_sent}
+
+    def _count(self, kind, sent=0):
+        with self.lock:
+            self.requests[kind] += 1
+            self.bytes_sent += sent
+        if self.latency:
+            time.sleep(self.latency)
+
+    # --- data ---
+    def get(self, path):
+        with self.lock:
+            return json.loads(json.dumps(get_node(self.tree, split_path(path))))
+
+    def put(self, path, value):
+        parts = split_path(path)
+        with self.lock:
+            self.tree = set_node(self.tree, parts, value)
+        self._notify('put', parts, value)
+
+    def patch(self, path, values):
+        parts = split_path(path)
+        with self.lock:
+            for key, value in values.items():
+                self.tree = set_node(self.tree, parts + split_path(key), value)
+        self._notify('patch', parts, values)
+
+    def _notify(self, event, parts, data):
+        for listen_parts, q in list(self.listeners):
+            if parts[:len(listen_parts)] == listen_parts:
+                rel = '/' + '/'.join(parts[len(listen_parts):])
+                q.put((event, {'path': rel, 'data': data}))
+            elif listen_parts[:len(parts)] == parts:
+                with self.lock:
+                    sub = get_node(self.tree, listen_parts)
+                q.put(('put', {'path': '/', 'data': sub}))
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _path(self):
+                path = urlsplit(self.path).path
+                return path[:-len('.json')] if path.endswith('.json') else path
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'null')
+
+            def _query(self):
+                return {k: v[-1] for k, v in parse_qs(urlsplit(self.path).query).items()}
+
+            def _send_json(self, value, status=200, etag=False, kind=None):
+                body = json.dumps(value).encode('utf-8')
+                tag = '"%s"' % hashlib.md5(body).hexdigest()
+                kind = kind or self.command
+                unchanged = etag and self.headers.get('If-None-Match') == tag
+                if unchanged and fake.not_modified:
+                    fake._count(f"{kind} 304")
+                    self.send_response(304)
+                    self.send_header('ETag', tag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                fake._count(f"{kind} unchanged" if unchanged else kind, len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', tag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _write_chunk(self, text):
+                data = text.encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _stream(self, path):
+                parts = split_path(path)
+                q = queue.Queue()
+                fake._count('STREAM')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                fake.listeners.append((parts, q))
+                try:
+                    self._write_chunk(
+                        f"event: put\ndata: {json.dumps({'path': '/', 'data': fake.get(path)})}\n\n"
+                    )
+                    while True:
+                        try:
+                            item = q.get(timeout=KEEP_ALIVE_INTERVAL)
+                        except queue.Empty:
+                            self._write_chunk("event: keep-alive\ndata: null\n\n")
+                            continue
+                        if item is None:
+                            break
+                        event, payload = item
+                        self._write_chunk(f"event: {event}\ndata: {json.dumps(payload)}\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    fake.listeners.remove((parts, q))
+                    try:
+                        self.wfile.write(b"0\r\n\r\n")
+                    except OSError:
+                        pass
+                    self.close_connection = True
+
+            def do_GET(self):
+                if 'text/event-stream' in (self.headers.get('Accept') or ''):
+                    return self._stream(self._path())
+                value = fake.get(self._path())
+                shallow = self._query().get('shallow') == 'true'
+                if shallow and isinstance(value, dict):
+                    value = {k: True for k in value}
+                self._send_json(value, etag=self.headers.get('X-Firebase-ETag') == 'true',
+                                kind='GET shallow' if shallow else 'GET')
+
+            def do_PUT(self):
+                value = self._body()
+                fake.put(self._path(), value)
+                self._send_json(value)
+
+            def do_PATCH(self):
+                values = self._body()
+                fake.patch(self._path(), values)
+                self._send_json(values)
+
+            def do_DELETE(self):
+                fake.put(self._path(), None)
+                self._send_json(None)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--seed', help='JSON file to load as the initial tree')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--not-modified', action='store_true', help='answer a matching If-None-Match with 304')
+    args = parser.parse_args()
+    seed = None
+    if args.seed:
+        with open(args.seed, encoding='utf-8') as f:
+            seed = json.load(f)
+    fake = FakeRTDB(seed, host=args.host, port=args.port, latency=args.latency, not_modified=args.not_modified)
+    print(f"🧪 Fake RTDB listening on {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
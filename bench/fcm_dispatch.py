@@ -0,0 +1,71 @@
+"""Benchmark dispatch_fcm() against a mocked messaging.send_each.
+
+The mock (fake_fcm.FakeFCM) sleeps `--latency` seconds per batch (one FCM
+round-trip) and rejects batches over 500 messages like the real API. The baseline builds a
+full Message graph per token and sends the batches one after another,
+which is what send_fcm_all did before the dispatch engine.
+
+    python bench/fcm_dispatch.py --tokens 1000 10000 50000 --latency 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_fcm import FakeFCM
+from fake_rtdb import FakeRTDB
+from run import isolated_env
+
+# Keep api.py away from production Firebase and the service's own files
+fake_db = FakeRTDB({'scopes': {}}).start()
+os.environ.update(isolated_env(fake_db.url))
+
+import api  # noqa: E402
+from firebase_admin import messaging  # noqa: E402
+
+
+def baseline(tokens, title, body):
+    success = 0
+    for i in range(0, len(tokens), api.FCM_BATCH_SIZE):
+        messages = [
+            messaging.Message(token=token, **api.build_message_template(title, body))
+            for token in tokens[i:i + api.FCM_BATCH_SIZE]
+        ]
+        success += sum(1 for r in messaging.send_each(messages).responses if r.success)
+    return success
+
+
+def run(n_tokens, latency):
+    tokens = [f"token-{i}" for i in range(n_tokens)]
+    result = {'tokens': n_tokens, 'latency_s': latency}
+    for name, fn in (('baseline', lambda: baseline(tokens, 'Title', 'Body')),
+                     ('dispatch', lambda: api.dispatch_fcm(tokens, 'Title', 'Body')[0])):
+        fcm = FakeFCM(latency).install()
+        start = time.perf_counter()
+        success = fn()
+        elapsed = time.perf_counter() - start
+        fcm.uninstall()
+        result[name] = {
+            'seconds': round(elapsed, 3),
+            'tokens_per_s': round(n_tokens / elapsed),
+            'success': success,
+            'batches': fcm.stats()['requests'].get('send_each', 0),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tokens', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+    results = [run(n, args.latency) for n in args.tokens]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
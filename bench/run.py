@@ -0,0 +1,401 @@
+"""Offline load test for api.py against local Firebase, FCM and Drive fakes.
+
+Scenarios (each in its own process, so peak RSS is per scenario):
+
+  sweep   N scopes x M tokens: poll sweeps over every scope, with a share
+          of scopes changing between sweeps and the resulting pushes
+          drained through the outbox
+  notify  POST /send-notification to scopes of 1k/10k/50k tokens; latency
+          is the request itself and enqueue-to-sent through the outbox
+  upload  concurrent POST /upload-file of 1MB..500MB bodies, streamed
+          through a real HTTP server into the fake Drive
+
+Prints one JSON document (throughput, p50/p99 latency, peak RSS and
+outbound request counts per fake) to compare runs across commits:
+
+    python bench/run.py > before.json
+    python bench/run.py --scenarios upload --sizes 1 100 500 --concurrency 2
+    python bench/run.py --scenarios sweep --scopes 200 --tokens 500 --rtdb-latency 0.05
+"""
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+MB = 1024 * 1024
+
+
+def percentile(values, p):
+    """Nearest-rank percentile; None for an empty list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def latency_summary(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        'count': len(ms),
+        'p50': round(percentile(ms, 50), 2) if ms else None,
+        'p99': round(percentile(ms, 99), 2) if ms else None,
+        'max': round(max(ms), 2) if ms else None,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (MB if sys.platform == 'darwin' else 1024), 1)
+
+
+def scope_doc(i, links=1, files=20):
+    return {
+        'quickLinks': [{'title': f'Link {n}', 'url': f'https://example.com/{i}/{n}'} for n in range(links)],
+        'schedules': [{'active': True, 'day': n % 7, 'time': '08:00', 'subject': 'Math',
+                       'doctor': 'Dr. X', 'message': 'Lecture'} for n in range(3)],
+        'recentUpdates': [],
+        'generalBroadcast': {'active': False},
+        'database': {'Math': {'Dr. X': {'root': [
+            {'type': 'file', 'name': f'file-{n}.pdf', 'ts': 1_600_000_000_000 + n} for n in range(files)
+        ]}}},
+    }
+
+
+def user_tokens(scope, n_tokens):
+    return {f'user{n}@example,com': {'tokens': [f'{scope}-token-{n}'], 'newFilesEnabled': n % 2 == 0}
+            for n in range(n_tokens)}
+
+
+def seed_scope(i, n_tokens, links=1):
+    scope = f'bench-scope-{i}'
+    return scope, {'data': json.dumps(scope_doc(i, links)), 'userTokens': user_tokens(scope, n_tokens)}
+
+
+# ==========================================
+# Child process: fakes + api, one scenario
+# ==========================================
+def isolated_env(rtdb_url, drive_url=None):
+    """Environment for importing api.py next to a running service: fakes
+    instead of Firebase/Drive, no watchers, and every lock, outbox, cache
+    and snapshot file in a private work directory removed at exit"""
+    workdir = tempfile.mkdtemp(prefix='unibot-bench-')
+    # Registered before api is imported, so it runs after api's own atexit handlers
+    atexit.register(shutil.rmtree, workdir, True)
+    env = {
+        'FIREBASE_DB_URL': rtdb_url,
+        'WATCHER_MODE': 'poll',
+        'RUN_WATCHERS': 'never',
+        'WATCHER_LOCK_PATH': os.path.join(workdir, 'watchers.lock'),
+        'OUTBOX_PATH': os.path.join(workdir, 'outbox.sqlite3'),
+        'FOLDER_CACHE_PATH': os.path.join(workdir, 'folder_cache.json'),
+        'UPLOAD_SPOOL_DIR': os.path.join(workdir, 'uploads'),
+        'RECENT_UPLOADS_PATH': os.path.join(workdir, 'recent-uploads.json'),
+        'PROMOTE_DIR': os.path.join(workdir, 'hot'),
+        'SNAPSHOT_PATH': os.path.join(workdir, 'snapshot.json'),
+        'TOPIC_STATE_PATH': os.path.join(workdir, 'topics.json'),
+    }
+    if drive_url:
+        env['DRIVE_API_ENDPOINT'] = drive_url
+        env['GOOGLE_TOKEN_URI'] = f'{drive_url}/token'
+    return env
+
+
+def boot(args, seed):
+    """Start the fakes, point api.py at them and import it"""
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from fake_drive import FakeDrive
+    from fake_fcm import FakeFCM
+    from fake_rtdb import FakeRTDB
+
+    rtdb = FakeRTDB(seed, latency=args.rtdb_latency, not_modified=args.rtdb_not_modified).start()
+    drive = FakeDrive(latency=args.drive_latency).start()
+    os.environ.update(isolated_env(rtdb.url, drive.url))
+    import api
+    fcm = FakeFCM(latency=args.fcm_latency).install()
+    return api, {'rtdb': rtdb, 'fcm': fcm, 'drive': drive}
+
+
+def outbound(fakes):
+    return {name: fake.stats() for name, fake in fakes.items()}
+
+
+def wait_for_outbox(api, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = api.outbox_stats()
+        if not stats.get('queued') and not stats.get('sending'):
+            return stats
+        time.sleep(0.05)
+    return api.outbox_stats()
+
+
+def scenario_sweep(args):
+    seed = {'scopes': dict(seed_scope(i, args.tokens) for i in range(args.scopes))}
+    api, fakes = boot(args, seed)
+    api.start_outbox()
+    changing = max(1, int(args.scopes * args.change))
+    durations = []
+    started = time.perf_counter()
+    for n in range(args.sweeps):
+        if n:
+            # Grow quickLinks on a rotating share of scopes so the watchers push
+            for i in range((n * changing) % args.scopes, (n * changing) % args.scopes + changing):
+                scope, doc = seed_scope(i % args.scopes, args.tokens, links=1 + n)
+                fakes['rtdb'].put(f'/scopes/{scope}/data', doc['data'])
+        with api.cadence_lock:
+            for state in api.scope_cadence.values():
+                state['next_poll'] = 0
+        t0 = time.perf_counter()
+        api.poll_due_scopes()
+        durations.append(time.perf_counter() - t0)
+    sweep_time = time.perf_counter() - started
+    outbox = wait_for_outbox(api, args.timeout)
+    drained = time.perf_counter() - started
+    return {
+        'params': {'scopes': args.scopes, 'tokens': args.tokens, 'sweeps': args.sweeps, 'change': args.change},
+        'throughput': {
+            'scope_polls_per_s': round(args.scopes * args.sweeps / sweep_time, 1),
+            'tokens_pushed_per_s': round(fakes['fcm'].stats()['messages'] / drained, 1),
+        },
+        'latency_ms': {'cold_sweep': latency_summary(durations[:1]), 'sweep': latency_summary(durations[1:])},
+        'outbox': outbox,
+        'peak_rss_mb': peak_rss_mb(),
+        'outbound': outbound(fakes),
+    }
+
+
+def scenario_notify(args):
+    seed, scopes = {'scopes': {}}, {}
+    for n_tokens in args.notify_tokens:
+        for r in range(args.repeat):
+            scope, doc = seed_scope(f'{n_tokens}-{r}', n_tokens)
+            seed['scopes'][scope] = doc
+            scopes.setdefault(n_tokens, []).append(scope)
+    api, fakes = boot(args, seed)
+    api.start_outbox()
+    client = api.app_flask.test_client()
+    results = []
+    for n_tokens, group in scopes.items():
+        before = fakes['fcm'].stats()['messages']
+        request_s, message_ids = [], []
+        started = time.perf_counter()
+        for scope in group:
+            t0 = time.perf_counter()
+            resp = client.post('/send-notification', json={'title': 'Bench', 'body': f'{n_tokens} tokens', 'scopeKey': scope})
+            request_s.append(time.perf_counter() - t0)
+            message_ids.append(resp.get_json()['messageId'])
+        end_to_end, statuses = [], {}
+        for message_id in message_ids:
+            deadline = time.time() + args.timeout
+            while True:
+                status = api.notification_status(message_id)
+                if status['status'] in ('sent', 'failed') or time.time() > deadline:
+                    break
+                time.sleep(0.02)
+            statuses[status['status']] = statuses.get(status['status'], 0) + 1
+            end_to_end.append((status['updatedAt'] - status['createdAt']) / 1000)
+        elapsed = time.perf_counter() - started
+        delivered = fakes['fcm'].stats()['messages'] - before
+        results.append({
+            'tokens': n_tokens,
+            'notifications': len(group),
+            'statuses': statuses,
+            'throughput': {'tokens_per_s': round(delivered / elapsed, 1)},
+            'latency_ms': {'request': latency_summary(request_s), 'enqueue_to_sent': latency_summary(end_to_end)},
+        })
+    return {
+        'params': {'tokens': args.notify_tokens, 'repeat': args.repeat},
+        'runs': results,
+        'peak_rss_mb': peak_rss_mb(),
+        'outbound': outbound(fakes),
+    }
+
+
+class MultipartBody:
+    """multipart/form-data body of `size` generated bytes, read lazily.
+
+    Every body starts with a unique prefix so Drive dedup never kicks in.
+    """
+
+    BLOCK = os.urandom(MB)
+
+    def __init__(self, fields, filename, size):
+        self.boundary = uuid.uuid4().hex
+        head = ''.join(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'
+                       for k, v in fields.items())
+        head += (f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/pdf\r\n\r\n')
+        prefix = uuid.uuid4().bytes
+        self.segments = [head.encode(), prefix, (max(0, size - len(prefix)),), f'\r\n--{self.boundary}--\r\n'.encode()]
+        self.length = sum(s[0] if isinstance(s, tuple) else len(s) for s in self.segments)
+        self.pos = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.length
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.length - self.pos
+        out, offset, want = [], 0, n
+        for seg in self.segments:
+            seg_len = seg[0] if isinstance(seg, tuple) else len(seg)
+            if want and self.pos < offset + seg_len:
+                start = self.pos - offset
+                take = min(want, seg_len - start)
+                if isinstance(seg, tuple):
+                    chunk = bytearray()
+                    while len(chunk) < take:
+                        at = (start + len(chunk)) % MB
+                        chunk += self.BLOCK[at:at + take - len(chunk)]
+                    chunk = bytes(chunk)
+                else:
+                    chunk = seg[start:start + take]
+                out.append(chunk)
+                self.pos += take
+                want -= take
+            offset += seg_len
+        return b''.join(out)
+
+
+def scenario_upload(args):
+    import requests
+    from werkzeug.serving import make_server
+
+    api, fakes = boot(args, {'scopes': {}})
+    server = make_server('127.0.0.1', 0, api.app_flask, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/upload-file'
+    results = []
+    for size_mb in args.sizes:
+        latencies, errors = [], []
+
+        def upload(n):
+            body = MultipartBody({'subject': 'Math', 'doctor': 'Dr. X', 'folder_path': 'Bench',
+                                  'scopeKey': 'bench-scope-upload', 'notify': 'false'},
+                                 f'bench-{size_mb}mb-{n}.pdf', int(size_mb * MB))
+            t0 = time.perf_counter()
+            resp = requests.post(url, data=body, headers={'Content-Type': body.content_type}, timeout=3600)
+            latencies.append(time.perf_counter() - t0)
+            if resp.status_code != 200 or not resp.json().get('success'):
+                errors.append(resp.text[:200])
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=upload, args=(n,)) for n in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        results.append({
+            'size_mb': size_mb,
+            'uploads': args.concurrency,
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'throughput': {'mb_per_s': round(size_mb * args.concurrency / elapsed, 1),
+                           'uploads_per_s': round(args.concurrency / elapsed, 2)},
+            'latency_ms': latency_summary(latencies),
+        })
+    server.shutdown()
+    return {
+        'params': {'sizes_mb': args.sizes, 'concurrency': args.concurrency},
+        'runs': results,
+        'peak_rss_mb': peak_rss_mb(),
+        'outbound': outbound(fakes),
+    }
+
+
+SCENARIOS = {'sweep': scenario_sweep, 'notify': scenario_notify, 'upload': scenario_upload}
+
+
+def child(name, args, results):
+    if not args.verbose:
+        # api.py logs every step to stdout; keep the JSON readable
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    try:
+        started = time.perf_counter()
+        result = SCENARIOS[name](args)
+        result['seconds'] = round(time.perf_counter() - started, 2)
+        results.put({'scenario': name, **result})
+    except Exception as e:
+        results.put({'scenario': name, 'error': f'{type(e).__name__}: {e}'})
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--scopes', type=int, default=50, help='sweep: number of scopes')
+    parser.add_argument('--tokens', type=int, default=1000, help='sweep: tokens per scope')
+    parser.add_argument('--sweeps', type=int, default=10)
+    parser.add_argument('--change', type=float, default=0.1, help='sweep: share of scopes changed per sweep')
+    parser.add_argument('--notify-tokens', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=5, help='notify: notifications per token count')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 10, 100], help='upload: file sizes in MB')
+    parser.add_argument('--concurrency', type=int, default=4, help='upload: parallel uploads per size')
+    parser.add_argument('--rtdb-latency', type=float, default=0.02)
+    parser.add_argument('--rtdb-not-modified', action='store_true',
+                        help='fake RTDB answers If-None-Match with 304 (real RTDB sends the full 200)')
+    parser.add_argument('--fcm-latency', type=float, default=0.1)
+    parser.add_argument('--drive-latency', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the outbox to drain')
+    parser.add_argument('--out', help='also write the JSON here')
+    parser.add_argument('--verbose', action='store_true', help="keep api.py's log output")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'latency_s': {'rtdb': args.rtdb_latency, 'fcm': args.fcm_latency, 'drive': args.drive_latency},
+        'scenarios': [],
+    }
+    for name in args.scenarios:
+        results = ctx.Queue()
+        proc = ctx.Process(target=child, args=(name, args, results))
+        proc.start()
+        result = None
+        while result is None and (proc.is_alive() or not results.empty()):
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                pass
+        proc.join()
+        report['scenarios'].append(result or {'scenario': name, 'error': f'exit code {proc.exitcode}'})
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()